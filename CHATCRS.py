@@ -1,47 +1,101 @@
-import typing
-import torch
-import json
-import os
-
-import nltk
-import openai
-import tiktoken
+import random
+import re
+import sys
+
 import numpy as np
 
-from loguru import logger
-from sklearn.metrics.pairwise import cosine_similarity
-from accelerate.utils import set_seed
-from thefuzz import fuzz
-from tqdm import tqdm
+from llm_backend import StopPattern, chat_completion, embed_completion, streaming_enabled
+from llm_cache import cached_chat
+from hedging import hedged_call
+from embedding_cache import get_embedding_cache
+from item_store import normalize_rows, similarity_scores
+from kg_resources import get_kg_resources
+from conversation import ConversationState, get_encoding
+from tracing import count, span
 
 # iEvaLM中的ChatCRS
+# 模型调用统一走 llm_backend（可替换为本地替身后端），并经过 rate_limit 的限流与重试
+# 模块导入时只加载numpy和本仓库的模块，tiktoken等依赖在用到时才导入（python startup_report.py 查看导入耗时）
+
+
+# 推荐系统的system提示词对所有对话相同，放在消息最前面，后面只追加对话内容，
+# 同一对话的后续轮次和不同对话之间都共享这段前缀（服务端前缀缓存命中的token数见 tracing 的 cached_tokens）
+CHAT_RECOMMENDER_INSTRUCTION = '''You are a recommender chatting with the user to provide recommendation. You must follow the instructions below during chat.
+If you do not have enough information about user preference, you should ask the user for his preference.
+If you have enough information about user preference, you can give recommendation. The recommendation list must contain 10 items that are consistent with user preference. The recommendation list can contain items that the dialog mentioned before. The format of the recommendation list is: no. title. Don't mention anything other than the title of items in your recommendation list.'''
 
-client = openai.OpenAI(
-    api_key="sk-zYW5O9J45Cq0dXHjipJlYJHKz63GiSUOGqsoxETlnFyRrsqk",
-    base_url="https://yunwu.ai/v1"
-)
 
+# 推荐列表的第10项已经完整（后面出现换行），流式模式下此时结束生成，回复截到第10项末尾，不包含列表后面的客套话
+RECOMMENDATION_LIST_COMPLETE = StopPattern(r"^[ \t]*10[ \t]*[.)][ \t]*\S[^\n]*(?=\n)", re.MULTILINE)
 
-def annotate_chat(messages, logit_bias=None):
-    """简化的Chat API调用"""
+
+def set_seed(seed):
+    """设置random和numpy的随机种子；torch只在已经被导入时才设置，不为此导入torch"""
+    random.seed(seed)
+    np.random.seed(seed)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed_all(seed)
+
+
+def annotate_chat(messages, logit_bias=None, stop_when=None):
+    """
+    简化的Chat API调用
+
+    Args:
+        stop_when: 流式模式下的提前结束条件（如 RECOMMENDATION_LIST_COMPLETE）
+    """
     if logit_bias is None:
         logit_bias = {}
+    # 提前结束的回复被截断，缓存键中包含结束条件本身
+    stop = stop_when.cache_key if stop_when is not None and streaming_enabled() else None
 
-
-    try:
-        response = client.chat.completions.create(
+    def create():
+        # 缓存未命中时才请求；启用对冲时慢请求会补发一次，取先返回的结果
+        return hedged_call(lambda: chat_completion(
+            messages,
             model='gpt-4o-mini',
-            messages=messages,
             temperature=0,
             logit_bias=logit_bias,
-            timeout=30
-        )
-        content = response.choices[0].message.content
+            timeout=30,
+            stop_when=stop_when
+        ).content, key="crs")
+
+    try:
+        content = cached_chat(create, model='gpt-4o-mini', messages=messages, temperature=0, logit_bias=logit_bias,
+                              stop=stop)
         # print(f"Chat API调用成功，回复长度: {len(content)}")
         return content
     except Exception as e:
+        # 限流器重试耗尽后直接抛出，不再用固定回复代替，避免写入错误的对话
         print(f"Chat API调用失败: {e}")
-        return "我可以帮您推荐电影。您能告诉我您喜欢什么类型的电影吗？或者您有特定的演员、导演或年份偏好吗？"
+        raise
+
+
+def summarize_messages(messages, previous_summary=None):
+    """摘要被截断的早期对话，供 ConversationState 的 'summarize' 模式使用"""
+    conv_str = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if previous_summary:
+        conv_str = f"Previous summary: {previous_summary}\n{conv_str}"
+    return annotate_chat([
+        {'role': 'system', 'content': "Summarize the conversation between a user and a recommender in under 80 words. "
+                                      "Keep the user's stated preferences and the items already recommended."},
+        {'role': 'user', 'content': conv_str}
+    ])
+
+
+class EmbeddingData:
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+
+class EmbeddingResponse:
+    """与OpenAI embedding返回值结构一致：response.data[0].embedding"""
+
+    def __init__(self, embeddings):
+        self.data = [EmbeddingData(embedding) for embedding in embeddings]
 
 
 def annotate(conv_str):
@@ -49,134 +103,210 @@ def annotate(conv_str):
     # print(f"调用Embedding API，文本长度: {len(conv_str)}")
 
     try:
-        response = client.embeddings.create(
-            model='text-embedding-ada-002',
-            input=conv_str,
-            timeout=30
-        )
+        embeddings = embed_completion([conv_str], model='text-embedding-ada-002', timeout=30)
         print("Embedding API调用成功")
-        return response
+        return EmbeddingResponse(embeddings)
     except Exception as e:
         print(f"Embedding API调用失败: {e}")
+        count("embedding_fallbacks")
 
         # 返回一个空的嵌入作为备用
-        class MockData:
-            embedding = [0.0] * 1536
-
-        class MockResponse:
-            data = [MockData()]
-
-        return MockResponse()
+        return EmbeddingResponse([[0.0] * 1536])
+
+
+# Embedding API单次请求的最大输入条数
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_DIM = 1536
+
+
+def annotate_many(conv_strs, batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    批量获取embedding，先查缓存，未命中的文本去重后按batch_size打包请求
+
+    Args:
+        conv_strs: 文本列表
+        batch_size: 单次请求的最大输入条数
+
+    Returns:
+        np.ndarray: (len(conv_strs), EMBEDDING_DIM) 的float32矩阵，请求失败的行为0向量
+    """
+    embeds = np.zeros((len(conv_strs), EMBEDDING_DIM), dtype=np.float32)
+    if len(conv_strs) == 0:
+        return embeds
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        keys = [cache.key(text) for text in conv_strs]
+        cached = cache.get_many(keys)
+    else:
+        keys = list(conv_strs)
+        cached = {}
+
+    # 未命中的文本去重，同一文本只请求一次
+    missing = {}
+    for i, key in enumerate(keys):
+        if key in cached:
+            embeds[i] = cached[key]
+        else:
+            missing.setdefault(key, []).append(i)
+
+    missing_keys = list(missing)
+    for start in range(0, len(missing_keys), batch_size):
+        batch_keys = missing_keys[start:start + batch_size]
+        batch_texts = [conv_strs[missing[key][0]] for key in batch_keys]
+        try:
+            batch_embeds = embed_completion(batch_texts, model='text-embedding-ada-002', timeout=30)
+        except Exception as e:
+            print(f"Embedding API调用失败: {e}")
+            count("embedding_fallbacks", len(batch_keys))
+            continue
+
+        batch_embeds = np.asarray(batch_embeds, dtype=np.float32)
+        for key, embed in zip(batch_keys, batch_embeds):
+            embeds[missing[key]] = embed
+        if cache is not None:
+            cache.put_many(batch_keys, batch_embeds)
+
+    return embeds
+
+
+def top_k_indices(sim_mat, k):
+    """
+    按行取相似度最高的k个下标（降序），不对整行做全排序
+
+    Args:
+        sim_mat: (n_query, n_item) 相似度矩阵
+        k: 取前k个
+
+    Returns:
+        np.ndarray: (n_query, min(k, n_item)) 的下标矩阵
+    """
+    k = min(k, sim_mat.shape[1])
+    if k < sim_mat.shape[1]:
+        top_idx = np.argpartition(-sim_mat, k - 1, axis=1)[:, :k]
+    else:
+        top_idx = np.broadcast_to(np.arange(k), sim_mat.shape).copy()
+    top_sim = np.take_along_axis(sim_mat, top_idx, axis=1)
+    order = np.argsort(-top_sim, axis=1, kind='stable')
+    return np.take_along_axis(top_idx, order, axis=1)
 
 
 class CHATCRS():
 
-    def __init__(self, seed, debug, kg_dataset) -> None:
+    def __init__(self, seed, debug, kg_dataset, use_ann=False, ann_nprobe=None, token_budget=None) -> None:
         self.seed = seed
         self.debug = debug
-        if self.seed is not None:
-            set_seed(self.seed)
+        # conv_dict中没有 'state' 时构建对话状态使用的token预算
+        self.token_budget = token_budget
+        # 不在这里调用 set_seed：重置全局的random/numpy种子会干扰并发的其他对话，
+        # 需要随机性的地方使用各自的random.Random（见 percrs.simulate_with_chatcrs）
 
         self.kg_dataset = kg_dataset
 
-        self.kg_dataset_path = f"src/data/{self.kg_dataset}"
-        with open(f"{self.kg_dataset_path}/entity2id.json", 'r', encoding="utf-8") as f:
-            self.entity2id = json.load(f)
-        with open(f"{self.kg_dataset_path}/id2info.json", 'r', encoding="utf-8") as f:
-            self.id2info = json.load(f)
-
-        self.id2entityid = {}
-        for id, info in self.id2info.items():
-            if info['name'] in self.entity2id:
-                self.id2entityid[id] = self.entity2id[info['name']]
-
-        self.item_embedding_path = f"src/save/embed/item/{self.kg_dataset}"
-
-        item_emb_list = []
-        id2item_id = []
-        if os.path.exists(self.item_embedding_path):
-            for i, file in tqdm(enumerate(os.listdir(self.item_embedding_path))):
-                item_id = os.path.splitext(file)[0]
-                if item_id in self.id2entityid:
-                    id2item_id.append(item_id)
-                    with open(f'{self.item_embedding_path}/{file}', encoding='utf-8') as f:
-                        embed = json.load(f)
-                        item_emb_list.append(embed)
-        else:
-            print(f"警告: 嵌入路径不存在 {self.item_embedding_path}")
+        # 只读资源在进程内共享，只有第一个对话需要加载
+        self.resources = get_kg_resources(self.kg_dataset)
+        self.entity2id = self.resources.entity2id
+        self.id2info = self.resources.id2info
+        self.id2entityid = self.resources.id2entityid
+        self.id2item_id_arr = self.resources.id2item_id_arr
+        self.item_emb_arr = self.resources.item_emb_arr
+
+        # 可选的IVF-PQ近似检索索引（python ann_index.py 离线构建）
+        self.ann_index = self.resources.get_ann_index() if use_ann else None
+        self.ann_nprobe = ann_nprobe
+
+        self.chat_recommender_instruction = CHAT_RECOMMENDER_INSTRUCTION
+
+    def get_state(self, conv_dict):
+        """
+        返回对话的ConversationState
+
+        conv_dict中带有 'state' 时直接使用（由调用方增量维护），
+        否则从 conv_dict['context'] 构建一个临时状态（使用CHATCRS的token预算）
+        """
+        state = conv_dict.get('state')
+        if state is None:
+            state = ConversationState(conv_dict['context'], token_budget=self.token_budget)
+        return state
+
+    def _get_conv_str(self, conv_dict):
+        """用最近两轮对话构造检索用的文本"""
+        conv_str = ""
 
-        self.id2item_id_arr = np.asarray(id2item_id)
-        self.item_emb_arr = np.asarray(item_emb_list)
+        for context in self.get_state(conv_dict).last_messages(2):
+            conv_str += f"{context['role']}: {context['content']} "
 
-        self.chat_recommender_instruction = '''You are a recommender chatting with the user to provide recommendation. You must follow the instructions below during chat.
-If you do not have enough information about user preference, you should ask the user for his preference.
-If you have enough information about user preference, you can give recommendation. The recommendation list must contain 10 items that are consistent with user preference. The recommendation list can contain items that the dialog mentioned before. The format of the recommendation list is: no. title. Don't mention anything other than the title of items in your recommendation list.'''
+        return conv_str
 
-    def get_rec(self, conv_dict):
+    def link_entities(self, conv_dict):
+        """对话中提到的KG实体id（按出现顺序，去重）"""
+        return self.resources.get_entity_linker().link_many(conv_dict['context'])
 
-        rec_labels = [self.entity2id[rec] for rec in conv_dict['rec'] if rec in self.entity2id]
+    def resolve_titles(self, titles):
+        """把推荐标题解析为实体id：先精确查entity2id，找不到时归一化/模糊匹配"""
+        entity_ids = []
+        for title in titles:
+            entity_id = self.entity2id.get(title)
+            if entity_id is None:
+                entity_id = self.resources.get_entity_linker().resolve(title)
+            if entity_id is not None:
+                entity_ids.append(entity_id)
+        return entity_ids
 
-        context = conv_dict['context']
-        context_list = []
+    def get_rec(self, conv_dict, k=50):
 
-        for i, text in enumerate(context):
-            if len(text) == 0:
-                continue
-            if i % 2 == 0:
-                role_str = 'user'
-            else:
-                role_str = 'assistant'
-            context_list.append({
-                'role': role_str,
-                'content': text
-            })
+        item_rank_arr, rec_labels = self.get_rec_batch([conv_dict], k=k)
 
-        conv_str = ""
+        return item_rank_arr, rec_labels[0]
 
-        for context in context_list[-2:]:
-            conv_str += f"{context['role']}: {context['content']} "
+    def get_rec_batch(self, conv_dicts, k=50, batch_size=1024):
+        """
+        批量检索推荐物品
+
+        所有对话的embedding一起请求，相似度按batch_size个查询一组做一次矩阵乘法，
+        再用argpartition取top-k，只对k个候选排序。
 
-        # 使用简化的annotate函数
-        conv_embed_response = annotate(conv_str)
-        conv_embed = conv_embed_response.data[0].embedding
-        conv_embed = np.asarray(conv_embed).reshape(1, -1)
+        Args:
+            conv_dicts: 对话字典列表
+            k: 每个对话返回的物品数
+            batch_size: 每次矩阵乘法的查询数，限制相似度矩阵的内存
+
+        Returns:
+            (item_rank_arr, rec_labels): 每个对话的top-k实体id列表和标注的推荐实体id列表
+        """
+        rec_labels = [self.resolve_titles(conv_dict['rec']) for conv_dict in conv_dicts]
 
         # 如果没有嵌入数据，跳过相似度计算
         if len(self.item_emb_arr) == 0:
             print("没有项目嵌入数据，返回空推荐")
-            return [[]], rec_labels
-
-        sim_mat = cosine_similarity(conv_embed, self.item_emb_arr)
-        rank_arr = np.argsort(sim_mat, axis=-1).tolist()
-        rank_arr = np.flip(rank_arr, axis=-1)[:, :50]
-        item_rank_arr = self.id2item_id_arr[rank_arr].tolist()
-        item_rank_arr = [[self.id2entityid[item_id] for item_id in item_rank_arr[0]]]
+            return [[] for _ in conv_dicts], rec_labels
+
+        with span("get_rec", batch=len(conv_dicts)):
+            # 带缓存的embedding请求
+            conv_embeds = annotate_many([self._get_conv_str(conv_dict) for conv_dict in conv_dicts])
+            conv_embeds = normalize_rows(conv_embeds)
+
+            item_rank_arr = []
+            for start in range(0, len(conv_embeds), batch_size):
+                if self.ann_index is not None:
+                    rank_arr = self.ann_index.search(conv_embeds[start:start + batch_size], k,
+                                                     vectors=self.item_emb_arr, nprobe=self.ann_nprobe)
+                else:
+                    # item_emb_arr 已经按行归一化，点积即余弦相似度；float16矩阵分块计算，不整体转换为float32
+                    sim_mat = similarity_scores(conv_embeds[start:start + batch_size], self.item_emb_arr)
+                    rank_arr = top_k_indices(sim_mat, k)
+                for rows in rank_arr:
+                    rows = rows[rows >= 0]
+                    item_rank_arr.append([self.id2entityid[item_id] for item_id in self.id2item_id_arr[rows].tolist()])
 
         return item_rank_arr, rec_labels
 
     def get_conv(self, conv_dict):
 
-        context = conv_dict['context']
-        context_list = []
-        context_list.append({
-            'role': 'system',
-            'content': self.chat_recommender_instruction
-        })
-
-        for i, text in enumerate(context):
-            if len(text) == 0:
-                continue
-            if i % 2 == 0:
-                role_str = 'user'
-            else:
-                role_str = 'assistant'
-            context_list.append({
-                'role': role_str,
-                'content': text
-            })
+        context_list = self.get_state(conv_dict).to_messages(system=self.chat_recommender_instruction)
 
         gen_inputs = None
-        gen_str = annotate_chat(context_list)
+        gen_str = annotate_chat(context_list, stop_when=RECOMMENDATION_LIST_COMPLETE)
 
         return gen_inputs, gen_str
 
@@ -187,26 +317,18 @@ If you have enough information about user preference, you can give recommendatio
             if st >= 0:
                 updated_options.append(options[i])
 
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        logit_bias = {encoding.encode(option)[0]: 10 for option in updated_options}
-
-        context = conv_dict['context']
-        context_list = []
-
-        for i, text in enumerate(context[:-1]):
-            if len(text) == 0:
-                continue
-            if i % 2 == 0:
-                role_str = 'user'
-            else:
-                role_str = 'assistant'
-            context_list.append({
-                'role': role_str,
-                'content': text
-            })
+        # 与 conversation.count_tokens 一样，没有安装tiktoken时退化处理：无法得到选项的token id，不加logit_bias，
+        # 只依靠提示词约束回复，取回复的第一个字符作为选项
+        encoding = get_encoding("gpt-3.5-turbo")
+        logit_bias = None
+        if encoding is not None:
+            logit_bias = {encoding.encode(option)[0]: 10 for option in updated_options}
+
+        conv_state = self.get_state(conv_dict)
+        context_list = conv_state.to_messages(include_last=False)
         context_list.append({
             'role': 'user',
-            'content': context[-1]
+            'content': conv_state.context[-1]
         })
 
         response_op = annotate_chat(context_list, logit_bias=logit_bias)
@@ -1,15 +1,39 @@
 import json
+import itertools
 from typing import List, Dict, Tuple, Optional
 from dataclasses import dataclass
-import openai  # 或其他LLM API
 from enum import Enum
-from openai import OpenAI
 import random
 
-client = OpenAI(
-        api_key="sk-zYW5O9J45Cq0dXHjipJlYJHKz63GiSUOGqsoxETlnFyRrsqk",  # 使用环境变量
-        base_url="https://yunwu.ai/v1"
-)
+import re
+
+from llm_backend import StopPattern, chat_completion, streaming_enabled
+from llm_cache import cached_chat
+from hedging import hedged_call
+
+# 表示用户想结束对话的说法（不区分大小写）
+END_PHRASES = [
+    "thank you", "thanks", "no more questions", "that's all",
+    "goodbye", "bye", "see you", "I'm done", "no thanks",
+    "not interested", "I'll stop here"
+]
+# 流式模式下出现结束语且所在的分句结束时停止生成：截到句末标点（含）或逗号/分号/换行之前。
+# 只包含 is_conversation_ended 能识别的结束语（它用原样的短语匹配小写化的回复，含大写字母的短语不会命中），
+# 不会因为不结束对话的说法截断回复
+END_PHRASE_CLAUSE = StopPattern(
+    r"(?:" + "|".join(re.escape(phrase) for phrase in END_PHRASES if phrase == phrase.lower())
+    + r")[^.!?,;\n]*(?:[.!?]|(?=[,;\n]))",
+    re.IGNORECASE)
+
+# 提示词按共享程度排列：所有用户相同的行为规则在最前，其次是人格描述（32种），用户画像放在最后，
+# 这样不同用户的请求共享最长的前缀，可以命中服务端的前缀缓存（cached_tokens记入tracing统计）
+USER_BEHAVIOR_RULES = """You must follow these instructions during the conversation:
+        1. Pretend you have limited knowledge about the recommended movies, and the only information source is the recommender.
+        2. You don't need to introduce yourself or recommend anything, but feel free to share personal interests and reflect on your personality.
+        3. When mentioning movie titles, put them in quotation marks (e.g., "Inception").
+        4. You may end the conversation if you're satisfied with the recommendation or lose interest (e.g., by saying "thank you" or "no more questions").
+        5. Keep your responses brief, ideally within 20 words. Be natural and conversational.
+        6. Respond based on your personality traits described below."""
 
 
 class PersonalityPolarity(Enum):
@@ -28,17 +52,30 @@ class PersonalityProfile:
     neuroticism: PersonalityPolarity
 
     @classmethod
-    def random(cls):
-        """生成随机人格特征"""
-        random.seed()
+    def random(cls, rng: Optional[random.Random] = None):
+        """生成随机人格特征；使用独立的随机数生成器，不重置全局随机种子"""
+        rng = rng or random.Random()
         return cls(
-            openness=random.choice(list(PersonalityPolarity)),
-            conscientiousness=random.choice(list(PersonalityPolarity)),
-            extraversion=random.choice(list(PersonalityPolarity)),
-            agreeableness=random.choice(list(PersonalityPolarity)),
-            neuroticism=random.choice(list(PersonalityPolarity))
+            openness=rng.choice(list(PersonalityPolarity)),
+            conscientiousness=rng.choice(list(PersonalityPolarity)),
+            extraversion=rng.choice(list(PersonalityPolarity)),
+            agreeableness=rng.choice(list(PersonalityPolarity)),
+            neuroticism=rng.choice(list(PersonalityPolarity))
         )
 
+    @classmethod
+    def from_vector(cls, vector: List[int]):
+        """由 to_vector 的 [-1, +1] 向量构建"""
+        if len(vector) != 5:
+            raise ValueError(f"人格向量应有5维: {vector}")
+        polarities = [PersonalityPolarity.POSITIVE if v > 0 else PersonalityPolarity.NEGATIVE for v in vector]
+        return cls(*polarities)
+
+    @classmethod
+    def all_vectors(cls) -> List[List[int]]:
+        """全部32种人格向量"""
+        return [list(vector) for vector in itertools.product([1, -1], repeat=5)]
+
     def to_vector(self) -> List[int]:
         """转换为向量表示 [-1, +1]"""
         return [
@@ -101,16 +138,32 @@ class UserProfile:
     disliked_movies: List[str]
     query: str
 
+    @classmethod
+    def from_durecdial(cls, entry: Dict):
+        """从DuRecDial数据条目构建用户画像，query取对话的第一句"""
+        profile = entry["user_profile"]
+        return cls(
+            name=profile["Name"],
+            gender=profile["Gender"],
+            age_range=profile["Age Range"],
+            residence=profile["Residence"],
+            liked_movies=profile["Accepted movies"],
+            liked_celebrities=profile["Accepted celebrities"],
+            disliked_movies=profile["Rejected movies"],
+            query=entry["conversation"][0].split('] ', 1)[1]
+        )
+
 class UserAgent:
     """基于LLM的人格化用户代理"""
 
     def __init__(
             self,
             user_profile: UserProfile,
-            max_response_length: int = 50  # 最大回复长度（词数）
+            max_response_length: int = 50,  # 最大回复长度（词数）
+            personality: Optional[PersonalityProfile] = None  # 不指定时随机生成
     ):
         self.user_profile = user_profile
-        self.personality_profile = PersonalityProfile.random()
+        self.personality_profile = personality or PersonalityProfile.random()
         self.max_response_length = max_response_length
 
 
@@ -118,7 +171,7 @@ class UserAgent:
         self.system_prompt = self._build_system_prompt()
 
     def _build_system_prompt(self) -> str:
-        """构建系统提示词（角色设定）"""
+        """构建系统提示词（角色设定），顺序为 行为规则 -> 人格 -> 用户画像"""
         # 用户基本信息
         profile_info = f"""You are {self.user_profile.name}, a {self.user_profile.gender} 
         in the age range of {self.user_profile.age_range}, living in {self.user_profile.residence}. 
@@ -129,21 +182,12 @@ class UserAgent:
         # 人格特质描述
         personality_desc = self.personality_profile.get_description()
 
-        # 行为规则
-        behavior_rules = """You must follow these instructions during the conversation:
-        1. Pretend you have limited knowledge about the recommended movies, and the only information source is the recommender.
-        2. You don't need to introduce yourself or recommend anything, but feel free to share personal interests and reflect on your personality.
-        3. When mentioning movie titles, put them in quotation marks (e.g., "Inception").
-        4. You may end the conversation if you're satisfied with the recommendation or lose interest (e.g., by saying "thank you" or "no more questions").
-        5. Keep your responses brief, ideally within 20 words. Be natural and conversational.
-        6. Respond based on your personality traits described above."""
-
         # 组合完整提示词
-        system_prompt = f"""{profile_info}
+        system_prompt = f"""{USER_BEHAVIOR_RULES}
 
 Your personality: {personality_desc}
 
-{behavior_rules}
+{profile_info}
 
 Now, let's start the conversation."""
 
@@ -166,27 +210,32 @@ Now, let's start the conversation."""
             {"role": "assistant", "content": system_message},
         ]
 
+        # 回复长度上限：英文约1.3个token一个词，max_response_length个词再留一些余量
+        max_tokens = self.max_response_length * 2
+        # 流式模式下结束语所在的分句结束即停止生成，截断后的回复仍包含结束语，is_conversation_ended 的判断不变
+        stop_when = END_PHRASE_CLAUSE
+        stop = stop_when.cache_key if streaming_enabled() else None
+
         # 调用LLM生成回复
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0
-        )
-        user_response = response.choices[0].message.content.strip()
+        def create():
+            return hedged_call(lambda: chat_completion(
+                messages,
+                model="gpt-4o-mini",
+                temperature=0,
+                max_tokens=max_tokens,
+                stop_when=stop_when
+            ).content, key="user")
+
+        user_response = cached_chat(create, model="gpt-4o-mini", messages=messages, temperature=0,
+                                    max_tokens=max_tokens, stop=stop).strip()
 
         return user_response
 
 
     def is_conversation_ended(self, user_response: str) -> bool:
         """判断用户是否想结束对话"""
-        end_phrases = [
-            "thank you", "thanks", "no more questions", "that's all",
-            "goodbye", "bye", "see you", "I'm done", "no thanks",
-            "not interested", "I'll stop here"
-        ]
-
         response_lower = user_response.lower()
-        for phrase in end_phrases:
+        for phrase in END_PHRASES:
             if phrase in response_lower:
                 return True
         return False
@@ -0,0 +1,241 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from item_store import get_packed_store_path, load_item_store, normalize_rows
+
+# 纯NumPy实现的IVF-PQ近似最近邻索引（内积/余弦相似度）
+#
+# - IVF：k-means粗聚类，查询时只扫描最相近的 nprobe 个簇
+# - PQ：簇内残差切成 m 段，每段用 2^nbits 个码字量化，每个向量只存 m 个字节
+# - 可选重排：用PQ分数取出 rerank 个候选，再用原始向量精确打分
+
+ANN_INDEX_FILE = "ann_ivfpq.npz"
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=42):
+    """简单的Lloyd k-means，返回 (n_clusters, dim) 的聚类中心"""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), n_clusters, replace=len(x) < n_clusters)].copy()
+    for _ in range(n_iter):
+        assign = assign_nearest(x, centroids)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # 空簇重新随机初始化
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty))]
+    return centroids
+
+
+def assign_nearest(x, centroids, batch_size=8192):
+    """按L2距离把每个向量分配到最近的中心"""
+    c_norm = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+        batch = np.asarray(x[start:start + batch_size], dtype=np.float32)
+        dist = c_norm[None, :] - 2 * batch @ centroids.T
+        assign[start:start + batch_size] = dist.argmin(axis=1)
+    return assign
+
+
+class IVFPQIndex:
+    """IVF-PQ索引，行号对应构建时传入矩阵的行"""
+
+    def __init__(self, nlist=256, m=48, nbits=8, nprobe=16, rerank=200, seed=42):
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.seed = seed
+
+        self.centroids = None  # (nlist, dim)
+        self.codebooks = None  # (m, 2^nbits, dim // m)
+        self.codes = None  # (n, m) uint8，按簇排列
+        self.ids = None  # (n,) 每个编码对应的原始行号
+        self.list_offsets = None  # (nlist + 1,) 每个簇在codes中的起止位置
+        self.item_ids = None  # 构建时的物品id，用于加载时校验行号
+
+    @property
+    def dim(self):
+        return self.centroids.shape[1]
+
+    def train(self, x, max_train_points=65536):
+        x = np.asarray(x, dtype=np.float32)
+        if x.shape[1] % self.m != 0:
+            raise ValueError(f"向量维度 {x.shape[1]} 不能被 m={self.m} 整除")
+        rng = np.random.default_rng(self.seed)
+        if len(x) > max_train_points:
+            x = x[np.sort(rng.choice(len(x), max_train_points, replace=False))]
+
+        self.nlist = min(self.nlist, len(x))
+        self.centroids = kmeans(x, self.nlist, seed=self.seed)
+        residuals = x - self.centroids[assign_nearest(x, self.centroids)]
+
+        ksub = 2 ** self.nbits
+        dsub = x.shape[1] // self.m
+        self.codebooks = np.stack([
+            kmeans(residuals[:, j * dsub:(j + 1) * dsub], ksub, n_iter=10, seed=self.seed + j)
+            for j in range(self.m)
+        ])
+        return self
+
+    def encode(self, residuals):
+        dsub = self.dim // self.m
+        codes = np.empty((len(residuals), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign_nearest(residuals[:, j * dsub:(j + 1) * dsub], self.codebooks[j])
+        return codes
+
+    def add(self, x, batch_size=8192):
+        """编码全部向量（只支持一次性构建）"""
+        assign_list, code_list = [], []
+        for start in range(0, len(x), batch_size):
+            batch = np.asarray(x[start:start + batch_size], dtype=np.float32)
+            assign = assign_nearest(batch, self.centroids)
+            assign_list.append(assign)
+            code_list.append(self.encode(batch - self.centroids[assign]))
+        assign = np.concatenate(assign_list)
+        codes = np.concatenate(code_list)
+
+        order = np.argsort(assign, kind='stable')
+        self.ids = order.astype(np.int64)
+        self.codes = codes[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.nlist))])
+        return self
+
+    def search(self, queries, k, vectors=None, nprobe=None):
+        """
+        检索内积最大的k个向量
+
+        Args:
+            queries: (n_query, dim) 查询向量
+            k: 返回数量
+            vectors: 原始向量矩阵，提供时对PQ候选做精确重排
+            nprobe: 扫描的簇数，None时使用索引的默认值
+
+        Returns:
+            np.ndarray: (n_query, k) 的行号矩阵，候选不足时用-1补齐
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        dsub = self.dim // self.m
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        n_candidates = max(k, self.rerank) if vectors is not None else k
+
+        results = np.full((len(queries), k), -1, dtype=np.int64)
+        coarse = queries @ self.centroids.T
+        probe_lists = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        for qi, q in enumerate(queries):
+            # 查询的每一段与对应码本的内积表 (m, 2^nbits)
+            lut = np.einsum('jd,jkd->jk', q.reshape(self.m, dsub), self.codebooks)
+
+            lists = probe_lists[qi]
+            starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+            sizes = ends - starts
+            if sizes.sum() == 0:
+                continue
+            pos = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            scores = np.repeat(coarse[qi, lists], sizes) + lut[np.arange(self.m), self.codes[pos]].sum(axis=1)
+
+            top = top_k(scores, n_candidates)
+            cand = self.ids[pos[top]]
+            if vectors is not None:
+                exact = np.asarray(vectors[np.sort(cand)], dtype=np.float32) @ q
+                cand = np.sort(cand)[top_k(exact, k)]
+            else:
+                cand = cand[:k]
+            results[qi, :len(cand)] = cand
+
+        return results
+
+    def save(self, path):
+        np.savez(
+            path,
+            params=np.asarray([self.nlist, self.m, self.nbits, self.nprobe, self.rerank, self.seed]),
+            centroids=self.centroids,
+            codebooks=self.codebooks,
+            codes=self.codes,
+            ids=self.ids,
+            list_offsets=self.list_offsets,
+            item_ids=np.asarray(self.item_ids if self.item_ids is not None else []),
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        nlist, m, nbits, nprobe, rerank, seed = data['params'].tolist()
+        index = cls(nlist=nlist, m=m, nbits=nbits, nprobe=nprobe, rerank=rerank, seed=seed)
+        index.centroids = data['centroids']
+        index.codebooks = data['codebooks']
+        index.codes = data['codes']
+        index.ids = data['ids']
+        index.list_offsets = data['list_offsets']
+        index.item_ids = data['item_ids'] if len(data['item_ids']) else None
+        return index
+
+    def remap_rows(self, item_ids):
+        """
+        将索引中的行号映射到当前物品矩阵的行号（物品集合被过滤过时使用），
+        当前矩阵中不存在的物品从索引中去掉
+        """
+        if self.item_ids is None or np.array_equal(self.item_ids, item_ids):
+            return self
+        row_of = {item_id: row for row, item_id in enumerate(np.asarray(item_ids).tolist())}
+        new_rows = np.asarray([row_of.get(item_id, -1) for item_id in self.item_ids.tolist()], dtype=np.int64)
+        rows = new_rows[self.ids]
+        keep = rows >= 0
+        list_of_pos = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        list_sizes = np.bincount(list_of_pos[keep], minlength=self.nlist)
+        self.ids = rows[keep]
+        self.codes = self.codes[keep]
+        self.list_offsets = np.concatenate([[0], np.cumsum(list_sizes)])
+        self.item_ids = np.asarray(item_ids)
+        return self
+
+
+def top_k(scores, k):
+    """一维分数的top-k下标（降序）"""
+    k = min(k, len(scores))
+    if k < len(scores):
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+
+def build_ann_index(item_emb_arr, item_ids=None, **kwargs):
+    index = IVFPQIndex(**kwargs)
+    index.train(item_emb_arr).add(item_emb_arr)
+    index.item_ids = None if item_ids is None else np.asarray(item_ids)
+    return index
+
+
+def get_ann_index_path(kg_dataset):
+    return os.path.join(get_packed_store_path(kg_dataset), ANN_INDEX_FILE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="为打包的物品embedding构建IVF-PQ索引")
+    parser.add_argument("--kg-dataset", default="opendialkg")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--m", type=int, default=48, help="PQ分段数，需整除向量维度")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--rerank", type=int, default=200)
+    args = parser.parse_args()
+
+    start = time.time()
+    item_ids, item_emb_arr, index_meta = load_item_store(get_packed_store_path(args.kg_dataset))
+    if not index_meta.get("normalized", False):
+        item_emb_arr = normalize_rows(item_emb_arr)
+    ann = build_ann_index(item_emb_arr, item_ids, nlist=args.nlist, m=args.m, nprobe=args.nprobe, rerank=args.rerank)
+    ann.save(get_ann_index_path(args.kg_dataset))
+    print(f"已构建 {len(item_ids)} 个物品的IVF-PQ索引到 {get_ann_index_path(args.kg_dataset)}，"
+          f"耗时 {time.time() - start:.1f}s")
@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# 离线基准套件：合成的知识图谱/物品embedding/数据集 + 本地替身后端，不需要网络和真实数据
+#
+# 测量项：
+#   load        资源加载耗时：cold 为新进程中导入CHATCRS并加载KG资源，warm 为同一进程内重新加载（页缓存已热）
+#   get_rec     不同物品库规模下 get_rec（单条）与 get_rec_batch（批量）的每秒查询数
+#   parse       数据集解析吞吐：read_jsonl_file（一次性读入）与 iter_user_profiles（流式）
+#   e2e         端到端每秒完成的对话数（本地后端零延迟，衡量本地开销）
+#
+# 用法（在仓库根目录）：
+#   python -m benchmarks.bench_suite --output bench.json
+#   python -m benchmarks.bench_suite --quick --baseline benchmarks/baseline_quick.json --threshold 0.2
+#   python -m benchmarks.bench_suite --quick --output benchmarks/baseline_quick.json     # 更新基线
+#
+# 与基线比较时任一指标变差超过 threshold（相对值）返回码为1。
+# 仓库中的 benchmarks/baseline_quick.json 由 --quick 在单核机器上生成（机器信息见其中的 meta），
+# 绝对数值与机器相关：在其他机器上比较前先用上面的命令在本机重新生成基线，比较时使用相同的规模参数。
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.bench_ann import synthetic_embeddings  # noqa: E402
+
+# simulate_with_chatcrs 固定使用 opendialkg
+E2E_DATASET = "opendialkg"
+
+
+def write_synthetic_kg(kg_dataset, n_items, dim=1536, seed=0):
+    """在当前目录下生成 src/data/<kg_dataset> 与打包的物品embedding"""
+    from item_store import ITEM_EMB_FILE, ITEM_INDEX_FILE, get_packed_store_path
+
+    kg_dataset_path = f"src/data/{kg_dataset}"
+    os.makedirs(kg_dataset_path, exist_ok=True)
+    names = [f"Movie {i}" for i in range(n_items)]
+    with open(f"{kg_dataset_path}/entity2id.json", 'w', encoding='utf-8') as f:
+        json.dump({name: i for i, name in enumerate(names)}, f)
+    with open(f"{kg_dataset_path}/id2info.json", 'w', encoding='utf-8') as f:
+        json.dump({str(i): {"name": name, "genre": ["Drama"]} for i, name in enumerate(names)}, f)
+
+    store_dir = get_packed_store_path(kg_dataset)
+    os.makedirs(store_dir, exist_ok=True)
+    np.save(os.path.join(store_dir, ITEM_EMB_FILE), synthetic_embeddings(n_items, dim=dim, seed=seed))
+    with open(os.path.join(store_dir, ITEM_INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump({"item_ids": [str(i) for i in range(n_items)], "dtype": "float32", "dim": dim,
+                   "normalized": True}, f)
+
+
+def write_synthetic_dataset(path, n_records, seed=0):
+    """DuRecDial格式的合成数据，约1/5的对话goal中包含Greetings（会被过滤）"""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(n_records):
+            goal = "[1]Greetings-->" if i % 5 == 0 else ""
+            goal += "[2] Movie recommendation(Movie 1)-->[3]Say goodbye"
+            record = {
+                "goal": goal,
+                "user_profile": {
+                    "Name": f"User {i}", "Gender": "Female" if i % 2 else "Male", "Age Range": "26-35",
+                    "Residence": "Beijing", "Occupation": "Student",
+                    "Accepted movies": [f"Movie {j}" for j in rng.integers(0, 1000, 3)],
+                    "Accepted celebrities": ["Na Xie"], "Rejected movies": [f"Movie {rng.integers(0, 1000)}"],
+                },
+                "situation": "Time: 2018-10-15, at home",
+                "conversation": ["[1] Hi, could you recommend a movie?"] +
+                                [f"Turn {t} of conversation {i}, talking about movies and stars." for t in range(12)],
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _quiet():
+    """屏蔽被测代码的print"""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def bench_load(kg_dataset, repeats=3):
+    from kg_resources import clear_kg_resources, get_kg_resources
+
+    code = ("import json, sys, time\n"
+            f"sys.path.insert(0, {REPO_ROOT!r})\n"
+            "start = time.perf_counter()\n"
+            "import CHATCRS\n"
+            "imported = time.perf_counter()\n"
+            "from kg_resources import get_kg_resources\n"
+            f"get_kg_resources({kg_dataset!r})\n"
+            "print(json.dumps([imported - start, time.perf_counter() - imported]))\n")
+    cold = []
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        cold.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    cold = np.asarray(cold)
+
+    warm = []
+    for _ in range(repeats):
+        clear_kg_resources()
+        start = time.perf_counter()
+        with _quiet():
+            get_kg_resources(kg_dataset)
+        warm.append(time.perf_counter() - start)
+
+    return {
+        "cold_import_s": float(np.median(cold[:, 0])),
+        "cold_load_s": float(np.median(cold[:, 1])),
+        "warm_load_s": float(np.median(warm)),
+    }
+
+
+def bench_get_rec(kg_dataset, n_queries=200, batch=64, k=50):
+    from CHATCRS import CHATCRS
+
+    with _quiet():
+        chatcrs = CHATCRS(seed=42, debug=False, kg_dataset=kg_dataset)
+    conv_dicts = [{"context": [f"I want a movie like number {i}", f"Sure, query {i}"], "rec": []}
+                  for i in range(n_queries)]
+
+    chatcrs.get_rec(conv_dicts[0], k=k)
+    start = time.perf_counter()
+    for conv_dict in conv_dicts:
+        chatcrs.get_rec(conv_dict, k=k)
+    single_qps = n_queries / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, n_queries, batch):
+        chatcrs.get_rec_batch(conv_dicts[i:i + batch], k=k)
+    batch_qps = n_queries / (time.perf_counter() - start)
+    return {"single_qps": single_qps, "batch_qps": batch_qps}
+
+
+def bench_parse(data_file, repeats=3):
+    from dataset_reader import iter_user_profiles
+    from percrs import read_jsonl_file
+
+    size_mb = os.path.getsize(data_file) / 1e6
+    with open(data_file, encoding='utf-8') as f:
+        n_lines = sum(1 for _ in f)
+
+    read_all, streaming = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        read_jsonl_file(data_file)
+        read_all.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in iter_user_profiles(data_file):
+            pass
+        streaming.append(time.perf_counter() - start)
+
+    return {
+        "read_jsonl_records_per_s": n_lines / min(read_all),
+        "iter_profiles_records_per_s": n_lines / min(streaming),
+        "iter_profiles_mb_per_s": size_mb / min(streaming),
+    }
+
+
+def bench_e2e(data_file, output_dir, n_conversations=40, concurrency=8):
+    from dataset_reader import iter_user_profiles
+    from percrs import run_simulations_async
+    from result_sink import JsonlResultSink
+
+    samples = list(iter_user_profiles(data_file, limit=n_conversations))
+    with JsonlResultSink(os.path.join(output_dir, "results.jsonl")) as sink, _quiet():
+        start = time.perf_counter()
+        results = asyncio.run(run_simulations_async(samples, sink, concurrency=concurrency))
+        elapsed = time.perf_counter() - start
+    completed = sum(result is not None for result in results)
+    return {"conversations_per_s": completed / elapsed, "completed": completed}
+
+
+def run(catalog_sizes=(1000, 10000, 50000), n_queries=200, n_records=5000, n_conversations=40, dim=1536):
+    from embedding_cache import configure_embedding_cache
+    from llm_backend import LocalBackend, set_backend
+    from llm_cache import configure_llm_cache
+
+    # 不使用持久化缓存，每次运行都测量完整路径
+    set_backend(LocalBackend(latency=0, embedding_dim=dim))
+    configure_llm_cache(enabled=False)
+    configure_embedding_cache(enabled=False)
+
+    workspace = tempfile.mkdtemp(prefix="percrs_bench_")
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        metrics = {}
+        write_synthetic_kg(E2E_DATASET, max(catalog_sizes), dim=dim)
+        for key, value in bench_load(E2E_DATASET).items():
+            metrics[f"load.{key}"] = value
+
+        for n_items in catalog_sizes:
+            kg_dataset = f"synthetic_{n_items}"
+            write_synthetic_kg(kg_dataset, n_items, dim=dim)
+            for key, value in bench_get_rec(kg_dataset, n_queries=n_queries).items():
+                metrics[f"get_rec.{n_items}.{key}"] = value
+
+        data_file = os.path.join(workspace, "dataset.jsonl")
+        write_synthetic_dataset(data_file, n_records)
+        for key, value in bench_parse(data_file).items():
+            metrics[f"parse.{key}"] = value
+
+        e2e = bench_e2e(data_file, workspace, n_conversations=n_conversations)
+        metrics["e2e.conversations_per_s"] = e2e["conversations_per_s"]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "catalog_sizes": list(catalog_sizes),
+            "n_queries": n_queries,
+            "n_records": n_records,
+            "n_conversations": n_conversations,
+        },
+        "metrics": metrics,
+    }
+
+
+def higher_is_better(name):
+    """耗时（*_s）越小越好，吞吐（*_qps、*_per_s）越大越好"""
+    return name.endswith("per_s") or not name.endswith("_s")
+
+
+def compare(current, baseline, threshold=0.2):
+    """
+    与基线逐项比较
+
+    Returns:
+        list: (指标, 基线值, 当前值, 相对变化, 是否回退)，相对变化为正表示变好
+    """
+    rows = []
+    for name, value in current["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if not base:
+            continue
+        change = (value - base) / base if higher_is_better(name) else (base - value) / base
+        rows.append((name, base, value, change, change < -threshold))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="检索、加载与模拟热路径的离线基准")
+    parser.add_argument("--catalog-sizes", default="1000,10000,50000", help="get_rec测试的物品库规模")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--records", type=int, default=5000, help="解析测试的数据条数")
+    parser.add_argument("--conversations", type=int, default=40, help="端到端测试的对话数")
+    parser.add_argument("--quick", action="store_true", help="缩小规模快速运行")
+    parser.add_argument("--output", default=None, help="结果JSON")
+    parser.add_argument("--baseline", default=None, help="基线JSON，提供时与之比较")
+    parser.add_argument("--threshold", type=float, default=0.2, help="允许的相对回退幅度")
+    args = parser.parse_args()
+
+    if args.quick:
+        report = run(catalog_sizes=(1000, 5000), n_queries=50, n_records=1000, n_conversations=10)
+    else:
+        report = run(catalog_sizes=tuple(int(x) for x in args.catalog_sizes.split(",")), n_queries=args.queries,
+                     n_records=args.records, n_conversations=args.conversations)
+
+    for name, value in report["metrics"].items():
+        print(f"{name:<45} {value:12.4f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, threshold=args.threshold)
+        regressions = [row for row in rows if row[4]]
+        print(f"\n与基线比较（阈值 {args.threshold:.0%}）:")
+        for name, base, value, change, regressed in rows:
+            print(f"  {'回退' if regressed else '    '} {name:<45} {base:12.4f} -> {value:12.4f} ({change:+.1%})")
+        if regressions:
+            print(f"{len(regressions)} 项指标回退")
+            sys.exit(1)
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+# 对话状态：增量追加消息，维护每条消息的token数，按token预算截断或摘要早期轮次
+#
+# CHATCRS.get_rec / get_conv / get_choice 共用同一个状态对象，不再每轮从context重建消息列表。
+
+# 每条消息在Chat格式中的额外开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    """返回缓存的tiktoken编码器，未安装tiktoken时返回None"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model="gpt-3.5-turbo") -> int:
+    """计算文本的token数，没有tiktoken时按4个字符一个token估算"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+class ConversationState:
+    """
+    一个对话的消息状态
+
+    context 与原来 conv_dict['context'] 含义相同：偶数位置是用户，奇数位置是推荐系统，可以包含空字符串。
+    messages 只包含非空的消息，并记录每条消息的token数和前缀和，截断窗口用二分查找得到。
+
+    Args:
+        context: 初始的对话文本列表
+        token_budget: 发送给模型的消息（含system）的token上限，None表示不限制
+        strategy: 超出预算时的处理方式，'truncate' 丢弃最早的消息，'summarize' 用summarizer摘要被丢弃的消息
+        summarizer: (被丢弃的消息列表, 之前的摘要) -> 新摘要
+        summary_budget: 'summarize' 模式下为摘要预留的token数
+        model: 计算token数使用的模型名
+    """
+
+    def __init__(self, context: Optional[List[str]] = None, token_budget: Optional[int] = None,
+                 strategy: str = 'truncate', summarizer: Optional[Callable] = None, summary_budget: int = 256,
+                 model: str = "gpt-3.5-turbo"):
+        if strategy not in ('truncate', 'summarize'):
+            raise ValueError(f"未知的截断方式: {strategy}")
+        self.token_budget = token_budget
+        self.strategy = strategy
+        self.summarizer = summarizer
+        self.summary_budget = summary_budget
+        self.model = model
+
+        self.context: List[str] = []
+        self.messages: List[Dict] = []
+        self.message_tokens: List[int] = []
+        self.message_context_index: List[int] = []
+        # 前缀和：_cum_tokens[i] 为前i条消息的token总数
+        self._cum_tokens: List[int] = [0]
+
+        self._summary = None
+        self._summary_upto = 0
+
+        for text in context or []:
+            self.append(text)
+
+    def __len__(self):
+        return len(self.context)
+
+    @property
+    def total_tokens(self) -> int:
+        return self._cum_tokens[-1]
+
+    def append(self, text: str):
+        """追加一条文本，角色由其在context中的位置决定"""
+        index = len(self.context)
+        self.context.append(text)
+        if len(text) == 0:
+            return
+        role = 'user' if index % 2 == 0 else 'assistant'
+        tokens = count_tokens(text, self.model) + MESSAGE_OVERHEAD_TOKENS
+        self.messages.append({'role': role, 'content': text})
+        self.message_tokens.append(tokens)
+        self.message_context_index.append(index)
+        self._cum_tokens.append(self._cum_tokens[-1] + tokens)
+
+    def fork(self) -> "ConversationState":
+        """复制当前状态（含token计数和已有摘要），之后两者各自追加互不影响"""
+        other = object.__new__(ConversationState)
+        other.__dict__.update(self.__dict__)
+        for name in ('context', 'messages', 'message_tokens', 'message_context_index', '_cum_tokens'):
+            setattr(other, name, list(getattr(self, name)))
+        return other
+
+    def last_messages(self, n: int) -> List[Dict]:
+        return self.messages[-n:] if n > 0 else []
+
+    def _window_start(self, end: int, budget: Optional[int]) -> int:
+        """返回在budget内能保留的最早消息下标，至少保留最后一条消息"""
+        if budget is None or end == 0:
+            return 0
+        # 找最小的start，使 cum[end] - cum[start] <= budget
+        start = bisect_left(self._cum_tokens, self._cum_tokens[end] - budget, 0, end + 1)
+        return min(start, end - 1)
+
+    def _get_summary(self, upto: int) -> Optional[str]:
+        """增量摘要：只把新被丢弃的消息和已有摘要一起交给summarizer"""
+        if upto <= self._summary_upto:
+            return self._summary
+        self._summary = self.summarizer(self.messages[self._summary_upto:upto], self._summary)
+        self._summary_upto = upto
+        return self._summary
+
+    def to_messages(self, system: Optional[str] = None, include_last: bool = True) -> List[Dict]:
+        """
+        生成发送给模型的消息列表
+
+        Args:
+            system: system提示词，放在最前面
+            include_last: 为False时不包含context最后一条文本对应的消息（get_choice会单独追加）
+
+        Returns:
+            list: 符合token预算的消息列表
+        """
+        end = len(self.messages)
+        if not include_last and end > 0 and self.message_context_index[-1] == len(self.context) - 1:
+            end -= 1
+
+        budget = self.token_budget
+        result = []
+        if system is not None:
+            result.append({'role': 'system', 'content': system})
+            if budget is not None:
+                budget -= count_tokens(system, self.model) + MESSAGE_OVERHEAD_TOKENS
+
+        use_summary = self.strategy == 'summarize' and self.summarizer is not None
+        if budget is not None and use_summary:
+            budget -= self.summary_budget
+        start = self._window_start(end, budget)
+
+        if start > 0 and use_summary:
+            summary = self._get_summary(start)
+            if summary:
+                result.append({'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"})
+
+        result.extend(self.messages[start:end])
+        return result
@@ -0,0 +1,152 @@
+import json
+import os
+from typing import Callable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from UserAgent import UserProfile
+
+# 流式读取DuRecDial格式的JSONL数据（每行一个对话）
+#
+# - 逐行读取、按需解析，只读取用到的行
+# - <数据文件>.idx.npy 保存每一行的字节偏移，用于跳过前面的记录或随机读取某一条
+# - 安装了 orjson 时使用 orjson 解析
+
+
+def get_json_loads() -> Callable:
+    """返回可用的最快JSON解析函数（接受bytes）"""
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+
+def get_line_index_path(filename):
+    return f"{filename}.idx.npy"
+
+
+def build_line_index(filename) -> np.ndarray:
+    """扫描一次数据文件，保存每一行起始位置的字节偏移"""
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    # 最后一个偏移是文件末尾，不对应任何一行
+    offsets = np.asarray(offsets[:-1], dtype=np.uint64)
+    index_path = get_line_index_path(filename)
+    tmp_path = index_path + ".tmp.npy"
+    np.save(tmp_path, offsets)
+    os.replace(tmp_path, index_path)
+    return offsets
+
+
+def load_line_index(filename, build=True) -> Optional[np.ndarray]:
+    """
+    加载行偏移索引，索引不存在或比数据文件旧时重新构建
+
+    Args:
+        filename: 数据文件
+        build: 索引不可用时是否构建；为False时返回None
+    """
+    index_path = get_line_index_path(filename)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(filename):
+        return np.load(index_path, mmap_mode='r')
+    if not build:
+        return None
+    return build_line_index(filename)
+
+
+def iter_records(filename, start=0, limit=None, predicate=None, loads=None,
+                 use_index=True) -> Iterator[Tuple[int, dict]]:
+    """
+    逐条读取JSONL记录
+
+    Args:
+        filename: 数据文件
+        start: 从第几行开始（0开始的行号），有行索引时直接跳转
+        limit: 最多返回多少条（满足predicate的）记录
+        predicate: 过滤函数，返回False的记录被跳过
+        loads: JSON解析函数，默认使用 get_json_loads()
+        use_index: start > 0 时是否使用（必要时构建）行索引
+
+    Yields:
+        (行号, 记录)：行号在同一文件中唯一且稳定，可作为样本id
+    """
+    if limit is not None and limit <= 0:
+        return
+    loads = loads or get_json_loads()
+
+    count = 0
+    with open(filename, 'rb') as f:
+        line_num = 0
+        if start > 0:
+            offsets = load_line_index(filename) if use_index else None
+            if offsets is not None:
+                if start >= len(offsets):
+                    return
+                f.seek(int(offsets[start]))
+                line_num = start
+            else:
+                for _ in range(start):
+                    if not f.readline():
+                        return
+                line_num = start
+
+        for line in f:
+            current_line = line_num
+            line_num += 1
+            line = line.strip()
+            if not line:  # 跳过空行
+                continue
+            try:
+                obj = loads(line)
+            except ValueError as e:
+                print(f"第 {current_line + 1} 行JSON解析错误: {e}")
+                print(f"问题内容前100字符: {line[:100]}")
+                continue
+            if predicate is not None and not predicate(obj):
+                continue
+
+            yield current_line, obj
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+
+def read_record(filename, line_num, loads=None) -> dict:
+    """按行号随机读取一条记录"""
+    offsets = load_line_index(filename)
+    loads = loads or get_json_loads()
+    with open(filename, 'rb') as f:
+        f.seek(int(offsets[line_num]))
+        return loads(f.readline())
+
+
+def exclude_goal(keyword="Greetings") -> Callable[[dict], bool]:
+    """过滤goal中包含某个阶段（子串匹配）的对话"""
+    def predicate(obj):
+        return keyword not in obj.get("goal", "")
+    return predicate
+
+
+def iter_user_profiles(filename, start=0, limit=None, exclude_goal_keyword="Greetings", loads=None,
+                       use_index=True) -> Iterator[Tuple[int, UserProfile]]:
+    """
+    逐条读取用户画像
+
+    Args:
+        filename: DuRecDial格式数据文件
+        start: 起始行号
+        limit: 最多返回多少个用户
+        exclude_goal_keyword: goal中包含该关键词的对话被跳过，None表示不过滤
+        loads: JSON解析函数
+        use_index: 是否使用行索引跳转
+
+    Yields:
+        (样本id, UserProfile)，样本id为数据文件中的行号
+    """
+    predicate = exclude_goal(exclude_goal_keyword) if exclude_goal_keyword else None
+    for line_num, obj in iter_records(filename, start=start, limit=limit, predicate=predicate, loads=loads,
+                                      use_index=use_index):
+        yield line_num, UserProfile.from_durecdial(obj)
@@ -0,0 +1,384 @@
+import argparse
+import os
+import re
+import sqlite3
+import time
+from functools import lru_cache
+from multiprocessing import Pool
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from dataset_reader import get_json_loads
+
+# DuRecDial数据的索引库
+#
+# 一次性把 en_dev.txt / zh_dev.txt 等原始数据多进程解析后写入SQLite：
+#   dialogs      每个对话一行：来源文件、行号、字节偏移与长度、goal、轮数、画像字段
+#   goal_stages  goal中的每个阶段（如 "movie recommendation"、"greetings"、"美食 推荐"）及其话题
+#   domains      对话涉及的领域（movie、music、food、poi、news、weather、star）
+# 对话内容不存入数据库，查询得到 (来源, 行号, 偏移, 长度) 后直接从原文件读取。
+#
+# 构建：python durecdial_store.py ingest data/en_dev.txt data/zh_dev.txt
+# 查询：python durecdial_store.py query --stage "movie recommendation" --exclude-stage greetings --min-turns 6
+#       加 --export data/movie_recommendation_data.txt 导出为 percrs.py 使用的数据文件
+
+DEFAULT_DB_PATH = "data/durecdial.sqlite"
+CHUNK_BYTES = 4 << 20
+
+_STAGE_RE = re.compile(r"^\s*\[\d+\]\s*(.*?)\s*(?:\((.*)\))?\s*$")
+
+DOMAIN_KEYWORDS = {
+    "movie": ("movie", "电影"),
+    "music": ("music", "音乐"),
+    "food": ("food", "美食"),
+    "poi": ("poi", "兴趣点"),
+    "news": ("news", "新闻"),
+    "weather": ("weather", "天气"),
+    "star": ("star", "celebrit", "明星"),
+}
+
+# 画像字段：英文数据与中文数据的键名
+PROFILE_FIELDS = {
+    "name": ("Name", "姓名"),
+    "gender": ("Gender", "性别"),
+    "age_range": ("Age Range", "年龄区间"),
+    "residence": ("Residence", "居住地"),
+    "occupation": ("Occupation", "职业状态"),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime REAL, num_dialogs INTEGER
+);
+CREATE TABLE IF NOT EXISTS dialogs (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL, line_num INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL,
+    goal TEXT, num_turns INTEGER,
+    name TEXT, gender TEXT, age_range TEXT, residence TEXT, occupation TEXT,
+    UNIQUE (source, line_num)
+);
+CREATE TABLE IF NOT EXISTS goal_stages (
+    dialog_id INTEGER NOT NULL, position INTEGER NOT NULL, stage TEXT NOT NULL, topic TEXT
+);
+CREATE TABLE IF NOT EXISTS domains (
+    dialog_id INTEGER NOT NULL, domain TEXT NOT NULL, PRIMARY KEY (domain, dialog_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_stage ON goal_stages (stage, dialog_id);
+CREATE INDEX IF NOT EXISTS idx_stage_dialog ON goal_stages (dialog_id);
+CREATE INDEX IF NOT EXISTS idx_turns ON dialogs (num_turns);
+CREATE INDEX IF NOT EXISTS idx_gender ON dialogs (gender);
+CREATE INDEX IF NOT EXISTS idx_age_range ON dialogs (age_range);
+CREATE INDEX IF NOT EXISTS idx_residence ON dialogs (residence);
+CREATE INDEX IF NOT EXISTS idx_occupation ON dialogs (occupation);
+"""
+
+
+def normalize_stage(stage: str) -> str:
+    return " ".join(stage.lower().split())
+
+
+def parse_goal(goal: str) -> List[Tuple[str, Optional[str]]]:
+    """"[1] Movie recommendation(A)-->[2]Say goodbye" -> [("movie recommendation", "A"), ("say goodbye", None)]"""
+    stages = []
+    for part in goal.split("-->"):
+        match = _STAGE_RE.match(part)
+        if match is None or not match.group(1):
+            continue
+        topic = match.group(2).strip() if match.group(2) else None
+        stages.append((normalize_stage(match.group(1)), topic))
+    return stages
+
+
+@lru_cache(maxsize=4096)
+def _stage_domains(stage: str) -> Tuple[str, ...]:
+    # 阶段名的种类很少，每种只匹配一次关键词
+    return tuple(domain for domain, keywords in DOMAIN_KEYWORDS.items() if any(keyword in stage for keyword in keywords))
+
+
+def get_domains(stages: Iterable[Tuple[str, Optional[str]]]) -> List[str]:
+    return sorted({domain for stage, _ in stages for domain in _stage_domains(stage)})
+
+
+def _profile_field(profile: Dict, field: str) -> Optional[str]:
+    for key in PROFILE_FIELDS[field]:
+        if key in profile:
+            value = profile[key]
+            return value if isinstance(value, str) else ", ".join(map(str, value))
+    return None
+
+
+def _parse_chunk(args):
+    """
+    解析文件中 [start, end) 字节范围内开始的行（在工作进程中执行）
+
+    Returns:
+        (rows, num_lines): rows 为 (块内行号, 偏移, 长度, goal, 轮数, 画像字段..., 阶段列表, 领域列表)
+    """
+    path, start, end = args
+    loads = get_json_loads()
+    rows = []
+    num_lines = 0
+    with open(path, 'rb') as f:
+        offset = start
+        if start > 0:
+            # 跳过上一个块负责的半行
+            f.seek(start - 1)
+            offset = start - 1 + len(f.readline())
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            local_line = num_lines
+            num_lines += 1
+            line_offset, offset = offset, offset + len(line)
+            if not line.strip():
+                continue
+            try:
+                obj = loads(line)
+            except ValueError:
+                continue
+            stages = parse_goal(obj.get("goal", ""))
+            profile = obj.get("user_profile", {})
+            rows.append((local_line, line_offset, len(line), obj.get("goal", ""), len(obj.get("conversation", [])),
+                         *(_profile_field(profile, field) for field in PROFILE_FIELDS),
+                         stages, get_domains(stages)))
+    return rows, num_lines
+
+
+class DuRecDialStore:
+    """
+    Args:
+        db_path: SQLite文件
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self._paths: Dict[str, str] = {}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ingest(self, path: str, source: Optional[str] = None, workers: Optional[int] = None,
+               force: bool = False) -> int:
+        """
+        解析一个数据文件并写入索引，文件未变化（大小和修改时间相同）时跳过
+
+        Args:
+            path: DuRecDial格式数据文件
+            source: 来源名，默认为文件名（如 en_dev.txt）
+            workers: 解析进程数，默认为CPU数
+            force: 文件未变化时也重新解析
+
+        Returns:
+            int: 写入的对话数，跳过时为0
+        """
+        source = source or os.path.basename(path)
+        size, mtime = os.path.getsize(path), os.path.getmtime(path)
+        row = self.conn.execute("SELECT size, mtime FROM sources WHERE source = ?", (source,)).fetchone()
+        if row is not None and tuple(row) == (size, mtime) and not force:
+            return 0
+
+        chunks = [(path, start, min(start + CHUNK_BYTES, size)) for start in range(0, size, CHUNK_BYTES)]
+        with self.conn:
+            self._delete_source(source)
+            next_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM dialogs").fetchone()[0]
+            line_base = 0
+            num_dialogs = 0
+            if workers == 1 or len(chunks) <= 1:
+                results = map(_parse_chunk, chunks)
+                pool = None
+            else:
+                pool = Pool(processes=workers)
+                results = pool.imap(_parse_chunk, chunks)
+            try:
+                for rows, num_lines in results:
+                    self._insert_rows(source, rows, line_base, next_id)
+                    next_id += len(rows)
+                    line_base += num_lines
+                    num_dialogs += len(rows)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            self.conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)",
+                              (source, os.path.abspath(path), size, mtime, num_dialogs))
+        self.conn.execute("ANALYZE")
+        return num_dialogs
+
+    def _delete_source(self, source):
+        ids = "SELECT id FROM dialogs WHERE source = ?"
+        self.conn.execute(f"DELETE FROM goal_stages WHERE dialog_id IN ({ids})", (source,))
+        self.conn.execute(f"DELETE FROM domains WHERE dialog_id IN ({ids})", (source,))
+        self.conn.execute("DELETE FROM dialogs WHERE source = ?", (source,))
+
+    def _insert_rows(self, source, rows, line_base, first_id):
+        dialog_rows, stage_rows, domain_rows = [], [], []
+        for dialog_id, (local_line, offset, length, goal, num_turns, *profile, stages, domains) in \
+                enumerate(rows, first_id):
+            dialog_rows.append((dialog_id, source, line_base + local_line, offset, length, goal, num_turns, *profile))
+            stage_rows.extend((dialog_id, position, stage, topic) for position, (stage, topic) in enumerate(stages))
+            domain_rows.extend((dialog_id, domain) for domain in domains)
+        self.conn.executemany("INSERT INTO dialogs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", dialog_rows)
+        self.conn.executemany("INSERT INTO goal_stages VALUES (?, ?, ?, ?)", stage_rows)
+        self.conn.executemany("INSERT OR IGNORE INTO domains VALUES (?, ?)", domain_rows)
+
+    def query(self, source: Optional[str] = None, stages: Sequence[str] = (), exclude_stages: Sequence[str] = (),
+              domains: Sequence[str] = (), min_turns: Optional[int] = None, max_turns: Optional[int] = None,
+              limit: Optional[int] = None, **profile) -> List[Tuple[str, int, int, int]]:
+        """
+        按条件查询对话
+
+        Args:
+            source: 只查询该来源
+            stages: goal必须包含的全部阶段（不区分大小写，如 "movie recommendation"）
+            exclude_stages: goal不能包含的阶段（如 "greetings"）
+            domains: 必须涉及的全部领域
+            min_turns / max_turns: 对话轮数（conversation条数）范围
+            limit: 最多返回多少条
+            **profile: 画像字段等值条件，如 gender="Female"
+
+        Returns:
+            list: (来源, 行号, 偏移, 长度)，按来源和行号排序
+        """
+        where, params = [], []
+        if source is not None:
+            where.append("d.source = ?")
+            params.append(source)
+        # 阶段/领域条件用 (stage, dialog_id) 索引得到id集合，不逐个对话探查
+        for stage in stages:
+            where.append("d.id IN (SELECT dialog_id FROM goal_stages WHERE stage = ?)")
+            params.append(normalize_stage(stage))
+        for stage in exclude_stages:
+            where.append("d.id NOT IN (SELECT dialog_id FROM goal_stages WHERE stage = ?)")
+            params.append(normalize_stage(stage))
+        for domain in domains:
+            where.append("d.id IN (SELECT dialog_id FROM domains WHERE domain = ?)")
+            params.append(domain)
+        if min_turns is not None:
+            where.append("d.num_turns >= ?")
+            params.append(min_turns)
+        if max_turns is not None:
+            where.append("d.num_turns <= ?")
+            params.append(max_turns)
+        for field, value in profile.items():
+            if field not in PROFILE_FIELDS:
+                raise ValueError(f"未知的画像字段: {field}")
+            where.append(f"d.{field} = ?")
+            params.append(value)
+
+        sql = "SELECT d.source, d.line_num, d.offset, d.length FROM dialogs d"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY d.source, d.line_num"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [tuple(row) for row in self.conn.execute(sql, params)]
+
+    def stage_counts(self, source: Optional[str] = None) -> List[Tuple[str, int]]:
+        """各阶段出现的对话数，用于查看可用的阶段名"""
+        sql = "SELECT s.stage, COUNT(DISTINCT s.dialog_id) FROM goal_stages s"
+        params = []
+        if source is not None:
+            sql += " JOIN dialogs d ON d.id = s.dialog_id WHERE d.source = ?"
+            params.append(source)
+        sql += " GROUP BY s.stage ORDER BY 2 DESC"
+        return [tuple(row) for row in self.conn.execute(sql, params)]
+
+    def _path(self, source):
+        if source not in self._paths:
+            row = self.conn.execute("SELECT path FROM sources WHERE source = ?", (source,)).fetchone()
+            if row is None:
+                raise KeyError(source)
+            self._paths[source] = row[0]
+        return self._paths[source]
+
+    def iter_raw(self, refs: Iterable[Tuple[str, int, int, int]]) -> Iterator[Tuple[Tuple, bytes]]:
+        """按查询结果从原文件读取原始行"""
+        files = {}
+        try:
+            for ref in refs:
+                source, _, offset, length = ref
+                if source not in files:
+                    files[source] = open(self._path(source), 'rb')
+                f = files[source]
+                f.seek(offset)
+                yield ref, f.read(length)
+        finally:
+            for f in files.values():
+                f.close()
+
+    def iter_records(self, refs: Iterable[Tuple[str, int, int, int]]) -> Iterator[Tuple[int, dict]]:
+        """(行号, 记录)，与 dataset_reader.iter_records 相同"""
+        loads = get_json_loads()
+        for ref, line in self.iter_raw(refs):
+            yield ref[1], loads(line)
+
+    def iter_user_profiles(self, refs: Iterable[Tuple[str, int, int, int]]):
+        """(行号, UserProfile)，与 dataset_reader.iter_user_profiles 相同（需要英文数据）"""
+        from UserAgent import UserProfile
+        for line_num, obj in self.iter_records(refs):
+            yield line_num, UserProfile.from_durecdial(obj)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DuRecDial数据索引库")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="解析数据文件并建立索引")
+    ingest_parser.add_argument("files", nargs="+")
+    ingest_parser.add_argument("--workers", type=int, default=None, help="解析进程数，默认为CPU数")
+    ingest_parser.add_argument("--force", action="store_true", help="文件未变化时也重新解析")
+
+    query_parser = subparsers.add_parser("query", help="按条件查询")
+    query_parser.add_argument("--source", default=None, help="来源文件名，如 en_dev.txt")
+    query_parser.add_argument("--stage", action="append", default=[], help="goal必须包含的阶段，可重复")
+    query_parser.add_argument("--exclude-stage", action="append", default=[], help="goal不能包含的阶段，可重复")
+    query_parser.add_argument("--domain", action="append", default=[], help="必须涉及的领域，可重复")
+    query_parser.add_argument("--min-turns", type=int, default=None)
+    query_parser.add_argument("--max-turns", type=int, default=None)
+    query_parser.add_argument("--gender", default=None)
+    query_parser.add_argument("--age-range", default=None)
+    query_parser.add_argument("--limit", type=int, default=None)
+    query_parser.add_argument("--export", default=None, help="把匹配的原始行写入该文件")
+    query_parser.add_argument("--list-stages", action="store_true", help="列出各阶段的对话数")
+    args = parser.parse_args()
+
+    with DuRecDialStore(args.db) as store:
+        if args.command == "ingest":
+            for path in args.files:
+                start = time.time()
+                num_dialogs = store.ingest(path, workers=args.workers, force=args.force)
+                elapsed = time.time() - start
+                if num_dialogs:
+                    print(f"{path}: {num_dialogs} 个对话，用时 {elapsed:.2f}s "
+                          f"（{os.path.getsize(path) / 1e6 / elapsed:.1f} MB/s）")
+                else:
+                    print(f"{path}: 未变化，跳过")
+        elif args.list_stages:
+            for stage, count in store.stage_counts(args.source):
+                print(f"{count:8d}  {stage}")
+        else:
+            profile = {field: value for field, value in (("gender", args.gender), ("age_range", args.age_range))
+                       if value is not None}
+            start = time.perf_counter()
+            refs = store.query(source=args.source, stages=args.stage, exclude_stages=args.exclude_stage,
+                               domains=args.domain, min_turns=args.min_turns, max_turns=args.max_turns,
+                               limit=args.limit, **profile)
+            print(f"{len(refs)} 个对话，查询用时 {(time.perf_counter() - start) * 1000:.1f} ms")
+            if args.export:
+                with open(args.export, 'wb') as f:
+                    for _, line in store.iter_raw(refs):
+                        f.write(line if line.endswith(b"\n") else line + b"\n")
+                print(f"已导出到 {args.export}")
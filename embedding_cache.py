@@ -0,0 +1,132 @@
+import fcntl
+import hashlib
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Embedding的持久化缓存：按内容哈希索引，向量以float32二进制追加存储
+#
+# 目录结构：
+#   vectors.f32  连续的float32行，每行dim个数
+#   keys.txt     每行 "<sha256> <行号>"，行号指向vectors.f32中的行
+#   .lock        多进程追加时使用的文件锁
+
+DEFAULT_EMBEDDING_CACHE_DIR = "data/cache/embeddings"
+
+
+class EmbeddingCache:
+    """按 (model, text) 的sha256缓存embedding向量，多线程/多进程安全"""
+
+    def __init__(self, path: str = DEFAULT_EMBEDDING_CACHE_DIR, model: str = 'text-embedding-ada-002',
+                 dim: int = 1536):
+        self.path = path
+        self.model = model
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_file = os.path.join(self.path, "vectors.f32")
+        self.keys_file = os.path.join(self.path, "keys.txt")
+        self.lock_file = os.path.join(self.path, ".lock")
+        for file in (self.vectors_file, self.keys_file, self.lock_file):
+            open(file, 'ab').close()
+
+        self._lock = threading.Lock()
+        self._index: Dict[str, int] = {}
+        self._keys_offset = 0
+        self._refresh()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _refresh(self):
+        """读取其他进程新追加的键"""
+        with open(self.keys_file, 'rb') as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        # 末尾不完整的行（写入中途）留到下次再读
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            key, row = line.decode("ascii").split()
+            self._index[key] = int(row)
+        self._keys_offset += end
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """返回已缓存的 {key: 向量}，未命中的键不在结果中"""
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                self._refresh()
+            rows = {key: self._index[key] for key in keys if key in self._index}
+            self.hits += len(rows)
+            self.misses += len(keys) - len(rows)
+
+        result = {}
+        if rows:
+            fd = os.open(self.vectors_file, os.O_RDONLY)
+            try:
+                for key, row in rows.items():
+                    buf = os.pread(fd, self.row_bytes, row * self.row_bytes)
+                    result[key] = np.frombuffer(buf, dtype=np.float32)
+            finally:
+                os.close(fd)
+        return result
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(keys), self.dim)
+        with self._lock, open(self.lock_file, 'wb') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # 先写向量再写键，键文件中出现的行号一定已经有对应的向量
+                with open(self.vectors_file, 'ab') as f:
+                    start = f.tell() // self.row_bytes
+                    f.seek(start * self.row_bytes)
+                    f.truncate()
+                    f.write(vectors.tobytes())
+                lines = "".join(f"{key} {start + i}\n" for i, key in enumerate(keys))
+                with open(self.keys_file, 'a', encoding='ascii') as f:
+                    f.write(lines)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            self._refresh()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": len(self._index),
+        }
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_enabled = True
+_embedding_cache_path = DEFAULT_EMBEDDING_CACHE_DIR
+_embedding_cache_lock = threading.Lock()
+
+
+def configure_embedding_cache(path: Optional[str] = None, enabled: bool = True):
+    """修改全局embedding缓存配置，下次调用 get_embedding_cache() 时生效"""
+    global _embedding_cache, _embedding_cache_enabled, _embedding_cache_path
+    with _embedding_cache_lock:
+        if path is not None:
+            _embedding_cache_path = path
+        _embedding_cache_enabled = enabled
+        _embedding_cache = None
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """返回全局embedding缓存实例，禁用时返回None"""
+    global _embedding_cache
+    if not _embedding_cache_enabled:
+        return None
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(_embedding_cache_path)
+        return _embedding_cache
@@ -0,0 +1,189 @@
+import re
+import unicodedata
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# 实体链接：在对话文本中一次扫描找出所有KG实体
+#
+# - 实体名与文本用同一规则归一化并切分成token（英文按单词，中文按单字），
+#   在token序列上构建Aho-Corasick自动机，一次扫描得到所有匹配，再取最左最长且互不重叠的结果
+# - 单个英文单词的实体名（如电影 "You"、"Her"、"Up"）在普通文本中多半不是在指实体：
+#   短于 min_single_chars 或是常用词时不放进自动机，只有加引号（"Her"、《Her》）时才链接，resolve 仍可精确解析
+# - resolve(title) 把推荐列表中的标题解析为实体id：先精确匹配归一化名称，失败时用字符三元组索引做模糊匹配
+#
+# 自动机随KG资源一起构建并在进程内共享（KGResources.get_entity_linker）。
+
+_TOKEN_RE = re.compile(r"[0-9a-z]+|[㐀-䶿一-鿿]")
+# 推荐列表中的序号和年份，如 "1. Inception (2010)"
+_TITLE_PREFIX_RE = re.compile(r"^\s*\d+\s*[.)、:]\s*")
+_TITLE_YEAR_RE = re.compile(r"\s*\(\d{4}\)\s*$")
+# 引号或书名号中的文本，按完整实体名精确匹配
+_QUOTED_RE = re.compile(r"[\"“《「]([^\"“”《》「」\n]{1,80})[\"”》」]")
+# 与实体名相同的常用词，单独出现时不链接
+STOP_WORDS = frozenset(
+    "about also anything been bound burn burned click common could doubt drive easy everything film films from "
+    "good great have just know like lost love made marked matched maybe more movie movies nothing only passing "
+    "play reached really some something speak super sure taken tempted than that them then there they think "
+    "this trapped trust unknown various very waiting want wanted watch what when where which whipped with would "
+    "your".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """NFKC、小写、去掉重音后切分为token"""
+    text = unicodedata.normalize("NFKD", unicodedata.normalize("NFKC", text).lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _TOKEN_RE.findall(text)
+
+
+def normalize(text: str) -> str:
+    return " ".join(tokenize(text))
+
+
+def _trigrams(text: str) -> List[str]:
+    padded = f"  {text} "
+    return list({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+class EntityLinker:
+    """
+    Args:
+        entity2id: 实体名 -> 实体id
+        min_chars: 归一化后短于该长度的实体名不参与文本中的匹配
+        skip_numeric: 纯数字的实体名（如年份）不参与文本中的匹配，避免把"10部电影"链接为实体
+        min_single_chars: 只有一个token的实体名短于该长度或是常用词（STOP_WORDS）时，只在加引号时匹配
+    """
+
+    def __init__(self, entity2id: Dict[str, int], min_chars: int = 2, skip_numeric: bool = True,
+                 min_single_chars: int = 4):
+        self.names: List[str] = []
+        self.ids: List[int] = []
+        # 归一化名称 -> 实体id，多个实体归一化后相同时保留id最小的
+        self.name2id: Dict[str, int] = {}
+        for name, entity_id in sorted(entity2id.items(), key=lambda x: x[1]):
+            key = normalize(name)
+            if key and key not in self.name2id:
+                self.name2id[key] = entity_id
+                self.names.append(key)
+                self.ids.append(entity_id)
+
+        self.vocab: Dict[str, int] = {}
+        self._build_automaton(min_chars, skip_numeric, min_single_chars)
+        self._build_trigram_index()
+
+    def _build_automaton(self, min_chars, skip_numeric, min_single_chars):
+        # goto[state]: token id -> 下一状态；out[state]: 以该状态结尾的 (token长度, 实体id)
+        self.goto: List[Dict[int, int]] = [{}]
+        self.out: List[Optional[Tuple[int, int]]] = [None]
+        for key, entity_id in self.name2id.items():
+            if len(key) < min_chars or (skip_numeric and key.replace(" ", "").isdigit()):
+                continue
+            tokens = key.split(" ")
+            if len(tokens) == 1 and (len(key) < min_single_chars or key in STOP_WORDS):
+                continue
+            state = 0
+            for token in tokens:
+                token_id = self.vocab.setdefault(token, len(self.vocab))
+                next_state = self.goto[state].get(token_id)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][token_id] = next_state
+                    self.goto.append({})
+                    self.out.append(None)
+                state = next_state
+            self.out[state] = (len(tokens), entity_id)
+
+        # fail[state]: 最长的真后缀状态；dict_link[state]: 沿fail链最近的有输出的状态
+        self.fail = [0] * len(self.goto)
+        self.dict_link = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token_id, next_state in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and token_id not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(token_id, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.dict_link[next_state] = target if self.out[target] is not None else self.dict_link[target]
+                queue.append(next_state)
+
+    def _build_trigram_index(self):
+        postings = defaultdict(list)
+        self.trigram_counts = np.zeros(len(self.names), dtype=np.int32)
+        for index, key in enumerate(self.names):
+            grams = _trigrams(key)
+            self.trigram_counts[index] = len(grams)
+            for gram in grams:
+                postings[gram].append(index)
+        self.postings = {gram: np.asarray(indices, dtype=np.int32) for gram, indices in postings.items()}
+
+    def find_mentions(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        文本中的实体提及
+
+        Returns:
+            list: (起始token, 结束token, 实体id)，按位置排列，取最左最长且互不重叠的匹配
+        """
+        matches = []
+        state = 0
+        for position, token in enumerate(tokenize(text)):
+            token_id = self.vocab.get(token)
+            if token_id is None:
+                state = 0
+                continue
+            while state and token_id not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token_id, 0)
+            hit = state if self.out[state] is not None else self.dict_link[state]
+            while hit:
+                length, entity_id = self.out[hit]
+                matches.append((position - length + 1, position + 1, entity_id))
+                hit = self.dict_link[hit]
+
+        for quoted in _QUOTED_RE.finditer(text):
+            key = normalize(quoted.group(1))
+            entity_id = self.name2id.get(key)
+            if entity_id is not None:
+                start = len(tokenize(text[:quoted.start(1)]))
+                matches.append((start, start + len(key.split(" ")), entity_id))
+
+        matches.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+        result, last_end = [], 0
+        for start, end, entity_id in matches:
+            if start >= last_end:
+                result.append((start, end, entity_id))
+                last_end = end
+        return result
+
+    def link(self, text: str) -> List[int]:
+        """文本中提到的实体id（按出现顺序，去重）"""
+        return list(dict.fromkeys(entity_id for _, _, entity_id in self.find_mentions(text)))
+
+    def link_many(self, texts: Iterable[str]) -> List[int]:
+        return list(dict.fromkeys(entity_id for text in texts for entity_id in self.link(text)))
+
+    def fuzzy_match(self, text: str, threshold: float = 0.8) -> Optional[int]:
+        """三元组Dice系数最高且不低于threshold的实体id"""
+        key = normalize(text)
+        grams = [gram for gram in _trigrams(key) if gram in self.postings]
+        if not key or not grams:
+            return None
+        overlap = np.bincount(np.concatenate([self.postings[gram] for gram in grams]), minlength=len(self.names))
+        scores = 2 * overlap / (len(_trigrams(key)) + self.trigram_counts)
+        best = int(np.argmax(scores))
+        return self.ids[best] if scores[best] >= threshold else None
+
+    def resolve(self, title: str, fuzzy: bool = True, threshold: float = 0.8) -> Optional[int]:
+        """把标题（可以带序号和年份）解析为实体id，找不到时返回None"""
+        title = _TITLE_YEAR_RE.sub("", _TITLE_PREFIX_RE.sub("", title))
+        entity_id = self.name2id.get(normalize(title))
+        if entity_id is None and fuzzy:
+            entity_id = self.fuzzy_match(title, threshold)
+        return entity_id
+
+    def resolve_many(self, titles: Iterable[str], fuzzy: bool = True, threshold: float = 0.8) -> List[int]:
+        """解析多个标题，忽略找不到的"""
+        entity_ids = (self.resolve(title, fuzzy=fuzzy, threshold=threshold) for title in titles)
+        return [entity_id for entity_id in entity_ids if entity_id is not None]
@@ -0,0 +1,331 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from entity_linker import EntityLinker, normalize
+from result_sink import read_jsonl_results
+
+# 离线评估模拟结果
+#
+# 从推荐系统每轮回复中解析 "no. title" 推荐列表，把标题解析为实体id（entity2id，找不到时用归一化标题），
+# 以用户画像中的 liked_movies 为目标、disliked_movies 为拒绝项，计算：
+#   recall@k      整个对话中所有推荐列表的前k项覆盖了多少喜欢的电影
+#   ndcg@k        对话中最好的一个推荐列表的NDCG@k
+#   hit_turn      第一次在前k项中推荐到喜欢的电影是第几轮（推荐系统的第几次回复），没有命中为NaN
+#   rejected_rate 推荐过的电影中不喜欢的电影所占比例
+#   turns         推荐系统的回复次数
+#
+# 文本解析逐条进行，之后所有对话的推荐列表放进一个 (对话数, 列表数, k) 的数组，指标全部用数组运算一次算出。
+# 结果可以按人格向量（conversation_summary.user_profile.personality）分组。
+#
+# 用法：python evaluate.py data/output/results.jsonl data/output/ --k 1 5 10 --by-personality
+
+_REC_ITEM_RE = re.compile(r"^\s*(\d{1,2})\s*[.)、]\s*(.+?)\s*$", re.MULTILINE)
+_TITLE_STRIP = " \t*\"'“”‘’《》"
+TRAITS = ("openness", "conscientiousness", "extraversion", "agreeableness", "neuroticism")
+
+
+def parse_rec_list(text: str) -> List[str]:
+    """推荐系统回复中的推荐列表（按序号排列的标题），没有列表时返回空列表"""
+    return [title.strip(_TITLE_STRIP) for _, title in _REC_ITEM_RE.findall(text or "")]
+
+
+def _iter_files(paths: Iterable[str]):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        # 旧的逐条JSON文件在前，同一样本也出现在JSONL中时以JSONL为准
+        yield from sorted(glob.glob(os.path.join(path, "simulation_*.json")))
+        yield from sorted(glob.glob(os.path.join(path, "results*.jsonl*")))
+        yield from sorted(glob.glob(os.path.join(path, "sweep_results*.jsonl*")))
+
+
+def _record_key(record: Dict, sweep: bool, source):
+    """
+    去重键：普通结果按样本id，人格扫描结果按 (样本id, 人格向量)；
+    没有样本id的旧结果无法判断是否重复，用 source（文件路径, 文件内序号）作键，每条都保留
+    """
+    if record.get("sample_id") is None:
+        return ("file",) + source
+    if sweep:
+        personality = record.get("conversation_summary", {}).get("user_profile", {}).get("personality")
+        return "sweep", record.get("sample_id"), tuple(personality or ())
+    return "run", record.get("sample_id")
+
+
+def iter_results(paths: Iterable[str]):
+    """
+    读取模拟结果，同一对话出现多次时（新旧格式并存、中断后重跑追加）只保留最后读到的一条
+
+    Args:
+        paths: JSONL结果文件（可以是.gz）、单个JSON结果文件或目录；
+            目录中读取 simulation_*.json、results*.jsonl* 和 sweep_results*.jsonl*
+    """
+    records = {}
+    for file in _iter_files(paths):
+        name = os.path.basename(file)
+        if ".jsonl" in name:
+            file_records = read_jsonl_results(file)
+        else:
+            with open(file, encoding='utf-8') as f:
+                file_records = [json.load(f)]
+        for index, record in enumerate(file_records):
+            key = _record_key(record, name.startswith("sweep_results"), (file, index))
+            # 先删除再插入，重复的记录排在最后写入的位置
+            records.pop(key, None)
+            records[key] = record
+    return iter(records.values())
+
+
+class TitleResolver:
+    """
+    把标题映射为整数id：能在entity2id中解析的用实体id，否则用归一化标题；
+    同一个标题只解析一次
+
+    Args:
+        entity2id: 实体名 -> 实体id，None表示只按归一化标题匹配
+    """
+
+    def __init__(self, entity2id: Optional[Dict[str, int]] = None):
+        self.linker = EntityLinker(entity2id) if entity2id else None
+        self.vocab: Dict = {}
+        self._cache: Dict[str, int] = {}
+
+    def __call__(self, title: str) -> int:
+        item = self._cache.get(title)
+        if item is None:
+            key = self.linker.resolve(title) if self.linker is not None else None
+            if key is None:
+                key = normalize(title)
+            item = self.vocab.setdefault(key, len(self.vocab))
+            self._cache[title] = item
+        return item
+
+    def many(self, titles: Iterable[str]) -> List[int]:
+        return [self(title) for title in titles if title]
+
+
+class EvalBatch:
+    """
+    所有对话的推荐列表和目标，填充为定长数组（-1表示空位）
+
+    rec:      (n, max_lists, k) 每个推荐列表的前k个物品
+    rec_turn: (n, max_lists) 推荐列表所在的轮次（推荐系统的第几次回复，从1开始）
+    liked, disliked: (n, max_liked) / (n, max_disliked)
+    """
+
+    def __init__(self, records: Iterable[Dict], resolver: TitleResolver, k: int):
+        self.k = k
+        rec_rows, turn_rows, liked_rows, disliked_rows = [], [], [], []
+        self.turns, self.personalities, self.sample_ids = [], [], []
+
+        for record in records:
+            lists, list_turns, n_system = [], [], 0
+            for role, text in record.get("conversation_history", []):
+                if role != "system":
+                    continue
+                n_system += 1
+                titles = parse_rec_list(text)
+                if titles:
+                    lists.append(resolver.many(titles)[:k])
+                    list_turns.append(n_system)
+            profile = record.get("user_profile", {})
+            rec_rows.append(lists)
+            turn_rows.append(list_turns)
+            liked_rows.append(resolver.many(profile.get("liked_movies", [])))
+            disliked_rows.append(resolver.many(profile.get("disliked_movies", [])))
+            self.turns.append(n_system)
+            summary = record.get("conversation_summary", {}).get("user_profile", {})
+            self.personalities.append(tuple(summary.get("personality") or ()))
+            self.sample_ids.append(record.get("sample_id"))
+
+        n = len(rec_rows)
+        max_lists = max((len(lists) for lists in rec_rows), default=0) or 1
+        self.rec = np.full((n, max_lists, k), -1, dtype=np.int64)
+        self.rec_turn = np.zeros((n, max_lists), dtype=np.int64)
+        for i, (lists, list_turns) in enumerate(zip(rec_rows, turn_rows)):
+            for j, items in enumerate(lists):
+                self.rec[i, j, :len(items)] = items
+            self.rec_turn[i, :len(list_turns)] = list_turns
+        self.liked = _pad(liked_rows)
+        self.disliked = _pad(disliked_rows)
+        self.turns = np.asarray(self.turns, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.turns)
+
+
+def _pad(rows: List[List[int]]) -> np.ndarray:
+    width = max((len(row) for row in rows), default=0) or 1
+    arr = np.full((len(rows), width), -1, dtype=np.int64)
+    for i, row in enumerate(rows):
+        arr[i, :len(row)] = row
+    return arr
+
+
+def _member(items: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """items[i, ...] 是否在 targets[i] 中（逐行的集合成员判断，-1不算）"""
+    n = len(items)
+    base = int(max(items.max(initial=0), targets.max(initial=0))) + 1
+    row = np.arange(n, dtype=np.int64).reshape((n,) + (1,) * (items.ndim - 1))
+    target_keys = (np.arange(n, dtype=np.int64)[:, None] * base + targets)[targets >= 0]
+    return np.isin(row * base + items, target_keys) & (items >= 0)
+
+
+def _unique_per_row(items: np.ndarray) -> np.ndarray:
+    """每行去重后的 (行号, 物品) 对，-1不算"""
+    n = len(items)
+    flat = items.reshape(n, -1)
+    base = int(flat.max(initial=0)) + 1
+    keys = np.unique((np.arange(n, dtype=np.int64)[:, None] * base + flat)[flat >= 0])
+    return np.stack([keys // base, keys % base], axis=1)
+
+
+def compute_metrics(batch: EvalBatch, ks: Iterable[int]) -> Dict[str, np.ndarray]:
+    """每个对话的指标，返回 指标名 -> (n,) 数组"""
+    n = len(batch)
+    metrics = {"turns": batch.turns.astype(float)}
+    n_liked = (batch.liked >= 0).sum(1)
+    has_list = batch.rec_turn > 0
+    # 命中矩阵只在最大的k上算一次，较小的k取前k列
+    hit_all = _member(batch.rec, batch.liked)
+
+    for k in ks:
+        rec = batch.rec[:, :, :k]
+        hit = hit_all[:, :, :k]
+
+        # recall@k：整个对话中推荐过的喜欢的电影（去重）
+        hit_pairs = _unique_per_row(np.where(hit, rec, -1))
+        hit_count = np.bincount(hit_pairs[:, 0], minlength=n)
+        metrics[f"recall@{k}"] = np.divide(hit_count, n_liked, out=np.full(n, np.nan), where=n_liked > 0)
+
+        # ndcg@k：每个列表的DCG除以理想DCG，取对话中最好的列表
+        discounts = 1.0 / np.log2(np.arange(k) + 2)
+        dcg = (hit * discounts).sum(-1)
+        ideal = np.concatenate([[0.0], np.cumsum(discounts)])[np.minimum(n_liked, k)]
+        ndcg = np.divide(dcg, ideal[:, None], out=np.zeros_like(dcg), where=ideal[:, None] > 0)
+        metrics[f"ndcg@{k}"] = np.where(n_liked > 0, np.where(has_list, ndcg, 0).max(1), np.nan)
+
+        # hit_turn@k：第一个命中的列表所在轮次
+        list_hit = hit.any(-1) & has_list
+        first = list_hit.argmax(1)
+        metrics[f"hit_turn@{k}"] = np.where(list_hit.any(1), batch.rec_turn[np.arange(n), first], np.nan)
+
+    # 推荐过的电影中不喜欢的比例
+    rec_pairs = _unique_per_row(batch.rec)
+    n_rec = np.bincount(rec_pairs[:, 0], minlength=n)
+    rejected = _member(batch.rec, batch.disliked)
+    rejected_pairs = _unique_per_row(np.where(rejected, batch.rec, -1))
+    n_rejected = np.bincount(rejected_pairs[:, 0], minlength=n)
+    metrics["rejected_rate"] = np.divide(n_rejected, n_rec, out=np.full(n, np.nan), where=n_rec > 0)
+    return metrics
+
+
+def aggregate(metrics: Dict[str, np.ndarray], groups: Optional[np.ndarray] = None,
+              n_groups: Optional[int] = None) -> Dict:
+    """
+    各指标的均值（忽略NaN）
+
+    Args:
+        groups: (n,) 分组编号，None表示不分组
+        n_groups: 分组数，默认为最大编号加1
+
+    Returns:
+        dict: 指标名 -> 均值数组（每组一个），另含 'count'
+    """
+    if groups is None:
+        groups = np.zeros(len(next(iter(metrics.values()))), dtype=np.int64)
+    if n_groups is None:
+        n_groups = int(groups.max(initial=-1)) + 1
+    result = {"count": np.bincount(groups, minlength=n_groups)}
+    for name, values in metrics.items():
+        valid = ~np.isnan(values)
+        total = np.bincount(groups[valid], weights=values[valid], minlength=n_groups)
+        num = np.bincount(groups[valid], minlength=n_groups)
+        result[name] = np.divide(total, num, out=np.full(n_groups, np.nan), where=num > 0)
+    return result
+
+
+def vector_label(vector) -> str:
+    return "".join("+" if v > 0 else "-" for v in vector) if vector else "unknown"
+
+
+def evaluate(records: Iterable[Dict], ks=(1, 5, 10), entity2id: Optional[Dict[str, int]] = None,
+             by_personality: bool = False, by_trait: bool = False) -> Dict:
+    """
+    计算整体和分组的平均指标
+
+    Returns:
+        dict: {'overall': {...}, 'personality': {向量: {...}}, 'trait': {维度+极性: {...}}}
+    """
+    batch = EvalBatch(records, TitleResolver(entity2id), max(ks))
+    metrics = compute_metrics(batch, ks)
+
+    def to_dicts(agg, labels):
+        return {label: {name: (int(values[i]) if name == "count" else float(values[i])) for name, values in agg.items()}
+                for i, label in enumerate(labels)}
+
+    report = {"overall": to_dicts(aggregate(metrics), ["all"])["all"]}
+    if by_personality:
+        labels, groups = np.unique([vector_label(p) for p in batch.personalities], return_inverse=True)
+        report["personality"] = to_dicts(aggregate(metrics, groups), labels)
+    if by_trait:
+        vectors = np.asarray([p if len(p) == len(TRAITS) else (0,) * len(TRAITS) for p in batch.personalities])
+        report["trait"] = {}
+        for index, trait in enumerate(TRAITS):
+            column = vectors[:, index] if len(vectors) else np.zeros(0, dtype=np.int64)
+            # 0: 负向, 1: 正向, 2: 未知
+            groups = np.where(column > 0, 1, np.where(column < 0, 0, 2))
+            agg = to_dicts(aggregate(metrics, groups, n_groups=3), [f"{trait}-", f"{trait}+", f"{trait}?"])
+            report["trait"].update({label: value for label, value in agg.items() if value["count"] > 0})
+    return report
+
+
+def print_report(report: Dict):
+    columns = [name for name in report["overall"] if name != "count"]
+    header = f"{'':<18}{'n':>7}" + "".join(f"{name:>14}" for name in columns)
+
+    def row(label, values):
+        return f"{label:<18}{values['count']:>7}" + "".join(f"{values[name]:>14.4f}" for name in columns)
+
+    print(header)
+    print(row("overall", report["overall"]))
+    for section in ("personality", "trait"):
+        if section in report:
+            print(f"\n按{'人格向量' if section == 'personality' else '人格维度'}:")
+            for label, values in report[section].items():
+                print(row(label, values))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="模拟结果的离线评估")
+    parser.add_argument("paths", nargs="+", help="结果文件（.jsonl/.jsonl.gz/.json）或输出目录")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--kg-dataset", default="opendialkg", help="标题解析使用的 src/data/<kg_dataset>/entity2id.json")
+    parser.add_argument("--no-kg", action="store_true", help="不使用entity2id，只按归一化标题匹配")
+    parser.add_argument("--by-personality", action="store_true", help="按32种人格向量分组")
+    parser.add_argument("--by-trait", action="store_true", help="按每个人格维度的正负分组")
+    parser.add_argument("--output", default=None, help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    entity2id = None
+    if not args.no_kg:
+        with open(f"src/data/{args.kg_dataset}/entity2id.json", encoding='utf-8') as f:
+            entity2id = json.load(f)
+
+    start = time.time()
+    report = evaluate(iter_results(args.paths), ks=sorted(set(args.k)), entity2id=entity2id,
+                      by_personality=args.by_personality, by_trait=args.by_trait)
+    print_report(report)
+    print(f"\n{report['overall']['count']} 个对话，用时 {time.time() - start:.2f}s")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
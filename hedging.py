@@ -0,0 +1,156 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+from tracing import count
+
+# 请求对冲（hedged requests）
+#
+# 一次调用超过该类调用延迟的第p百分位仍未返回时，再发一个相同的请求，取先返回的结果。
+# 对冲请求数不超过总调用数的 max_extra_fraction，避免在整体变慢时放大负载。
+# 温度为0的调用两次请求结果相同，取哪一个不影响对话内容。
+
+
+class LatencyTracker:
+    """滑动窗口内的延迟分布，百分位每记录 refresh_every 次重新计算一次"""
+
+    def __init__(self, window: int = 500, refresh_every: int = 20):
+        self.samples = deque(maxlen=window)
+        self.refresh_every = refresh_every
+        self._since_refresh = 0
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self.samples.append(latency)
+            self._since_refresh += 1
+            if self._since_refresh >= self.refresh_every:
+                self._sorted = sorted(self.samples)
+                self._since_refresh = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            values = self._sorted or sorted(self.samples)
+        if not values:
+            return None
+        index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+        return values[index]
+
+
+class Hedger:
+    """
+    Args:
+        percentile: 超过该百分位延迟时发出对冲请求
+        max_extra_fraction: 对冲请求数占调用数的上限
+        min_samples: 延迟样本少于该数时不对冲
+        max_workers: 执行请求的线程数
+    """
+
+    def __init__(self, percentile: float = 95, max_extra_fraction: float = 0.05, min_samples: int = 20,
+                 window: int = 500, max_workers: int = 64):
+        self.percentile = percentile
+        self.max_extra_fraction = max_extra_fraction
+        self.min_samples = min_samples
+        self.window = window
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def tracker(self, key: str) -> LatencyTracker:
+        with self._lock:
+            if key not in self._trackers:
+                self._trackers[key] = LatencyTracker(window=self.window)
+            return self._trackers[key]
+
+    def _timed(self, fn, tracker):
+        def run():
+            start = time.monotonic()
+            result = fn()
+            tracker.record(time.monotonic() - start)
+            return result
+        return run
+
+    def _try_reserve_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.max_extra_fraction * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def call(self, fn: Callable, key: str = "default"):
+        """调用fn，必要时发出一个对冲请求，返回先成功的结果"""
+        tracker = self.tracker(key)
+        with self._lock:
+            self.calls += 1
+        threshold = tracker.percentile(self.percentile) if len(tracker) >= self.min_samples else None
+
+        # 在调用方的contextvars中执行，请求计入调用方当前的追踪span
+        primary = self._executor.submit(contextvars.copy_context().run, self._timed(fn, tracker))
+        if threshold is None:
+            return primary.result()
+
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._try_reserve_hedge():
+            return primary.result()
+
+        backup = self._executor.submit(contextvars.copy_context().run, self._timed(fn, tracker))
+        count("hedges")
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        with self._lock:
+                            self.hedge_wins += 1
+                        count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "extra_fraction": self.hedges / self.calls if self.calls else 0.0,
+            }
+            trackers = dict(self._trackers)
+        for key, tracker in trackers.items():
+            stats[f"p{self.percentile:g}_{key}"] = tracker.percentile(self.percentile)
+        return stats
+
+
+_hedger: Optional[Hedger] = None
+_hedger_lock = threading.Lock()
+
+
+def configure_hedging(enabled: bool = True, **kwargs):
+    """启用/关闭全局对冲，参数同 Hedger"""
+    global _hedger
+    with _hedger_lock:
+        _hedger = Hedger(**kwargs) if enabled else None
+
+
+def get_hedger() -> Optional[Hedger]:
+    return _hedger
+
+
+def hedged_call(fn: Callable, key: str = "default"):
+    """未启用对冲时直接调用fn"""
+    hedger = _hedger
+    if hedger is None:
+        return fn()
+    return hedger.call(fn, key=key)
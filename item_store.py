@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# 物品embedding的打包存储：一个连续的 .npy 矩阵 + 物品id索引文件
+#
+# src/save/embed/item/<dataset>/<item_id>.json   原始的每物品一个JSON文件
+# src/save/embed/packed/<dataset>/item_emb.npy   打包后的矩阵（float32 或 float16）
+# src/save/embed/packed/<dataset>/item_index.json 行号 -> 物品id
+
+ITEM_EMB_FILE = "item_emb.npy"
+ITEM_INDEX_FILE = "item_index.json"
+
+
+def get_raw_embedding_path(kg_dataset):
+    return f"src/save/embed/item/{kg_dataset}"
+
+
+def get_packed_store_path(kg_dataset):
+    return f"src/save/embed/packed/{kg_dataset}"
+
+
+def load_valid_item_ids(kg_dataset):
+    """返回在entity2id中有对应实体的物品id集合（与CHATCRS中的id2entityid一致）"""
+    kg_dataset_path = f"src/data/{kg_dataset}"
+    with open(f"{kg_dataset_path}/entity2id.json", 'r', encoding="utf-8") as f:
+        entity2id = json.load(f)
+    with open(f"{kg_dataset_path}/id2info.json", 'r', encoding="utf-8") as f:
+        id2info = json.load(f)
+    return {id for id, info in id2info.items() if info['name'] in entity2id}
+
+
+def normalize_rows(arr):
+    """按行L2归一化，返回float32矩阵；全0行保持为0"""
+    arr = np.asarray(arr, dtype=np.float32)
+    if arr.size == 0:
+        return arr
+    norms = np.linalg.norm(arr, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return arr / norms
+
+
+def similarity_scores(queries, item_emb_arr, block_rows=8192):
+    """
+    查询向量与物品矩阵的点积，返回 (n_query, n_item) 的float32矩阵
+
+    float32矩阵直接相乘；float16（通常是内存映射）按 block_rows 行一块转换为float32再相乘，
+    不会在每次查询时把整个矩阵复制成float32，额外内存只有一块的大小。
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    if item_emb_arr.dtype == np.float32:
+        return queries @ item_emb_arr.T
+    scores = np.empty((len(queries), len(item_emb_arr)), dtype=np.float32)
+    for start in range(0, len(item_emb_arr), block_rows):
+        block = np.asarray(item_emb_arr[start:start + block_rows], dtype=np.float32)
+        scores[:, start:start + len(block)] = queries @ block.T
+    return scores
+
+
+def build_item_store(embedding_dir, store_dir, valid_item_ids=None, dtype='float32'):
+    """
+    将每物品一个JSON的embedding目录打包成一个连续矩阵
+
+    逐个文件写入预先分配好的 .npy 内存映射，峰值内存约为单个向量大小。
+    写入前按行L2归一化，加载后可直接用点积计算余弦相似度。
+
+    Args:
+        embedding_dir: 原始embedding目录（<item_id>.json）
+        store_dir: 输出目录
+        valid_item_ids: 只打包这些物品，None表示全部
+        dtype: 'float32' 或 'float16'
+
+    Returns:
+        int: 打包的物品数
+    """
+    files = []
+    for file in sorted(os.listdir(embedding_dir)):
+        item_id, ext = os.path.splitext(file)
+        if ext != '.json':
+            continue
+        if valid_item_ids is None or item_id in valid_item_ids:
+            files.append((item_id, file))
+
+    os.makedirs(store_dir, exist_ok=True)
+    if len(files) == 0:
+        print(f"警告: {embedding_dir} 中没有可打包的embedding")
+        return 0
+
+    with open(os.path.join(embedding_dir, files[0][1]), encoding='utf-8') as f:
+        dim = len(json.load(f))
+
+    emb_path = os.path.join(store_dir, ITEM_EMB_FILE)
+    tmp_path = emb_path + ".tmp"
+    emb_arr = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(dtype), shape=(len(files), dim))
+    for row, (item_id, file) in enumerate(files):
+        with open(os.path.join(embedding_dir, file), encoding='utf-8') as f:
+            emb_arr[row] = normalize_rows(json.load(f))
+    emb_arr.flush()
+    del emb_arr
+
+    index = {
+        "item_ids": [item_id for item_id, _ in files],
+        "dtype": np.dtype(dtype).name,
+        "dim": dim,
+        "normalized": True,
+    }
+    with open(os.path.join(store_dir, ITEM_INDEX_FILE) + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    # 先写临时文件再替换，正在读取旧文件的进程不受影响
+    os.replace(tmp_path, emb_path)
+    os.replace(os.path.join(store_dir, ITEM_INDEX_FILE) + ".tmp", os.path.join(store_dir, ITEM_INDEX_FILE))
+
+    return len(files)
+
+
+def has_item_store(store_dir):
+    return os.path.exists(os.path.join(store_dir, ITEM_EMB_FILE)) and \
+        os.path.exists(os.path.join(store_dir, ITEM_INDEX_FILE))
+
+
+def load_item_store(store_dir, mmap=True):
+    """
+    加载打包的物品embedding
+
+    Args:
+        store_dir: 打包目录
+        mmap: 是否内存映射（只读），同一台机器上的多个进程共享同一份页缓存
+
+    Returns:
+        (item_ids, item_emb_arr, index): 物品id数组、embedding矩阵、索引元数据
+    """
+    with open(os.path.join(store_dir, ITEM_INDEX_FILE), encoding='utf-8') as f:
+        index = json.load(f)
+    item_emb_arr = np.load(os.path.join(store_dir, ITEM_EMB_FILE), mmap_mode='r' if mmap else None)
+    item_ids = np.asarray(index["item_ids"])
+    return item_ids, item_emb_arr, index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="打包物品embedding")
+    parser.add_argument("--kg-dataset", default="opendialkg")
+    parser.add_argument("--float16", action="store_true", help="以float16存储，体积减半")
+    args = parser.parse_args()
+
+    start = time.time()
+    num_items = build_item_store(
+        get_raw_embedding_path(args.kg_dataset),
+        get_packed_store_path(args.kg_dataset),
+        valid_item_ids=load_valid_item_ids(args.kg_dataset),
+        dtype='float16' if args.float16 else 'float32'
+    )
+    print(f"已打包 {num_items} 个物品embedding到 {get_packed_store_path(args.kg_dataset)}，"
+          f"耗时 {time.time() - start:.1f}s")
@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+# 知识图谱的CSR（压缩稀疏行）存储
+#
+# kg.json 是 {实体id: [[关系id, 实体id], ...]} 的字典，读取时要把整个文件解析成Python列表。
+# CSR用三个可内存映射的数组表示同一张图：
+#   kg_indptr.npy     (num_nodes + 1,) int64，节点i的边为 [indptr[i], indptr[i+1])
+#   kg_indices.npy    (num_edges,) int32，边的另一端实体id
+#   kg_relations.npy  (num_edges,) int16，关系id
+#   kg_csr.json       元数据：num_nodes、num_edges、num_relations
+#
+# 图中同时保存反向边（如 演员 -> 电影），反向边的关系id为 原关系id + num_relations，
+# 这样从电影出发两跳即可找到同演员/同导演的其他电影。每个节点的边按 (关系, 实体) 排序并去重。
+#
+# 从已有的kg.json转换：python kg_graph.py --kg-dataset opendialkg
+
+INDPTR_FILE = "kg_indptr.npy"
+INDICES_FILE = "kg_indices.npy"
+RELATIONS_FILE = "kg_relations.npy"
+META_FILE = "kg_csr.json"
+
+
+class CSRGraph:
+    """
+    Args:
+        indptr, indices, relations: CSR数组
+        num_relations: 正向关系数，关系id >= num_relations 的是反向边
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, relations: np.ndarray, num_relations: int):
+        self.indptr = indptr
+        self.indices = indices
+        self.relations = relations
+        self.num_relations = num_relations
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices)
+
+    @classmethod
+    def from_edges(cls, src, rel, dst, num_nodes: int, num_relations: int, add_reverse: bool = True) -> "CSRGraph":
+        """由边列表构建，add_reverse 为True时加入反向边"""
+        src = np.asarray(src, dtype=np.int64)
+        rel = np.asarray(rel, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        if add_reverse:
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+            rel = np.concatenate([rel, rel + num_relations])
+
+        # 按 (src, rel, dst) 排序去重
+        key = np.unique((src * (2 * num_relations) + rel) * num_nodes + dst)
+        dst = key % num_nodes
+        rel = (key // num_nodes) % (2 * num_relations)
+        src = key // num_nodes // (2 * num_relations)
+
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=num_nodes), out=indptr[1:])
+        return cls(indptr, dst.astype(np.int32), rel.astype(np.int16), num_relations)
+
+    @classmethod
+    def from_adjacency(cls, kg: Dict, num_nodes: Optional[int] = None, num_relations: Optional[int] = None,
+                       add_reverse: bool = True) -> "CSRGraph":
+        """由 kg.json 格式的字典构建"""
+        counts = [len(edges) for edges in kg.values()]
+        src = np.repeat(np.fromiter((int(node) for node in kg), dtype=np.int64, count=len(kg)), counts)
+        pairs = np.asarray([edge for edges in kg.values() for edge in edges], dtype=np.int64).reshape(-1, 2)
+        rel, dst = pairs[:, 0], pairs[:, 1]
+        if num_nodes is None:
+            num_nodes = int(max(src.max(initial=-1), dst.max(initial=-1))) + 1
+        if num_relations is None:
+            num_relations = int(rel.max(initial=-1)) + 1
+        return cls.from_edges(src, rel, dst, num_nodes, num_relations, add_reverse=add_reverse)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, INDPTR_FILE), self.indptr)
+        np.save(os.path.join(directory, INDICES_FILE), self.indices)
+        np.save(os.path.join(directory, RELATIONS_FILE), self.relations)
+        with open(os.path.join(directory, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"num_nodes": self.num_nodes, "num_edges": self.num_edges,
+                       "num_relations": self.num_relations}, f)
+
+    @classmethod
+    def load(cls, directory, mmap: bool = True) -> "CSRGraph":
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(directory, INDPTR_FILE), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, INDICES_FILE), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, RELATIONS_FILE), mmap_mode=mmap_mode),
+                   meta["num_relations"])
+
+    def degree(self, node: int) -> int:
+        return int(self.indptr[node + 1] - self.indptr[node])
+
+    def edges(self, node: int):
+        """节点的 (关系id数组, 实体id数组)"""
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.relations[start:end], self.indices[start:end]
+
+    def neighbors(self, node: int, relation: Optional[Union[int, Iterable[int]]] = None) -> np.ndarray:
+        """
+        节点的邻居
+
+        Args:
+            relation: 只返回这些关系的邻居；单个关系时用二分查找直接取出连续的一段
+        """
+        start, end = int(self.indptr[node]), int(self.indptr[node + 1])
+        if relation is None:
+            return self.indices[start:end]
+        relations = self.relations[start:end]
+        if np.isscalar(relation):
+            lo, hi = np.searchsorted(relations, [relation, relation + 1])
+            return self.indices[start + lo:start + hi]
+        return self.indices[start:end][np.isin(relations, list(relation))]
+
+    def _expand(self, frontier: np.ndarray, relation):
+        """frontier所有节点的邻居（未去重）"""
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # 把每个节点的 [start, end) 区间拼接成一个下标数组
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        edge_idx = offsets + np.arange(total)
+        neighbors = self.indices[edge_idx]
+        if relation is not None:
+            allowed = [relation] if np.isscalar(relation) else list(relation)
+            neighbors = neighbors[np.isin(self.relations[edge_idx], allowed)]
+        return neighbors.astype(np.int64)
+
+    def k_hop(self, seeds: Iterable[int], k: int, relation=None, max_nodes: Optional[int] = None) -> np.ndarray:
+        """
+        k跳之内可达的节点（不含种子节点），按跳数由近到远排列
+
+        Args:
+            seeds: 起始节点
+            k: 最大跳数
+            relation: 只沿这些关系扩展
+            max_nodes: 达到该数量后停止扩展
+        """
+        frontier = np.unique(np.asarray(list(seeds), dtype=np.int64))
+        visited = np.zeros(self.num_nodes, dtype=bool)
+        visited[frontier] = True
+        reached: List[np.ndarray] = []
+        n_reached = 0
+        for _ in range(k):
+            if len(frontier) == 0:
+                break
+            neighbors = np.unique(self._expand(frontier, relation))
+            frontier = neighbors[~visited[neighbors]]
+            visited[frontier] = True
+            reached.append(frontier)
+            n_reached += len(frontier)
+            if max_nodes is not None and n_reached >= max_nodes:
+                break
+        result = np.concatenate(reached) if reached else np.empty(0, dtype=np.int64)
+        return result[:max_nodes] if max_nodes is not None else result
+
+
+def has_csr_graph(directory) -> bool:
+    return all(os.path.exists(os.path.join(directory, file))
+               for file in (INDPTR_FILE, INDICES_FILE, RELATIONS_FILE, META_FILE))
+
+
+def convert_kg_json(kg_dataset_path) -> CSRGraph:
+    """把 <kg_dataset_path>/kg.json 转为CSR并保存在同一目录"""
+    with open(os.path.join(kg_dataset_path, "kg.json"), encoding='utf-8') as f:
+        kg = json.load(f)
+    num_nodes = num_relations = None
+    if os.path.exists(os.path.join(kg_dataset_path, "entity2id.json")):
+        with open(os.path.join(kg_dataset_path, "entity2id.json"), encoding='utf-8') as f:
+            num_nodes = len(json.load(f))
+    if os.path.exists(os.path.join(kg_dataset_path, "relation2id.json")):
+        with open(os.path.join(kg_dataset_path, "relation2id.json"), encoding='utf-8') as f:
+            num_relations = len(json.load(f))
+    graph = CSRGraph.from_adjacency(kg, num_nodes=num_nodes, num_relations=num_relations)
+    graph.save(kg_dataset_path)
+    return graph
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="把kg.json转换为CSR格式")
+    parser.add_argument("--kg-dataset", default="opendialkg")
+    args = parser.parse_args()
+
+    start = time.time()
+    graph = convert_kg_json(f"src/data/{args.kg_dataset}")
+    print(f"{graph.num_nodes} 个节点，{graph.num_edges} 条边（含反向边），用时 {time.time() - start:.2f}s")
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+from typing import Dict
+
+import numpy as np
+
+from ann_index import IVFPQIndex, get_ann_index_path
+from entity_linker import EntityLinker
+from kg_graph import CSRGraph, convert_kg_json, has_csr_graph
+from item_store import get_raw_embedding_path, get_packed_store_path, has_item_store, load_item_store, normalize_rows
+
+# 进程内共享的知识图谱/物品embedding资源
+#
+# 同一个kg_dataset只在进程内第一次使用时加载，之后所有CHATCRS实例（包括不同线程中的）
+# 共享同一份只读数据，每个对话只创建轻量的对话状态。
+
+
+class KGResources:
+    """一个kg_dataset的只读资源：实体映射、物品信息、物品embedding矩阵"""
+
+    def __init__(self, kg_dataset):
+        self.kg_dataset = kg_dataset
+
+        self.kg_dataset_path = f"src/data/{self.kg_dataset}"
+        with open(f"{self.kg_dataset_path}/entity2id.json", 'r', encoding="utf-8") as f:
+            self.entity2id = json.load(f)
+        with open(f"{self.kg_dataset_path}/id2info.json", 'r', encoding="utf-8") as f:
+            self.id2info = json.load(f)
+
+        self.id2entityid = {}
+        for id, info in self.id2info.items():
+            if info['name'] in self.entity2id:
+                self.id2entityid[id] = self.entity2id[info['name']]
+
+        self.item_embedding_path = get_raw_embedding_path(self.kg_dataset)
+        self.item_store_path = get_packed_store_path(self.kg_dataset)
+
+        if has_item_store(self.item_store_path):
+            # 打包的embedding矩阵，内存映射加载
+            self.id2item_id_arr, self.item_emb_arr, index = load_item_store(self.item_store_path)
+            valid = np.asarray([item_id in self.id2entityid for item_id in self.id2item_id_arr], dtype=bool)
+            if not valid.all():
+                self.id2item_id_arr = self.id2item_id_arr[valid]
+                self.item_emb_arr = self.item_emb_arr[valid]
+            if not index.get("normalized", False):
+                self.item_emb_arr = normalize_rows(self.item_emb_arr)
+        else:
+            self._load_item_embeddings_from_json()
+            self.item_emb_arr = normalize_rows(self.item_emb_arr)
+
+        self._ann_index = None
+        self._kg_graph = None
+        self._entity_linker = None
+        self._lock = threading.Lock()
+
+    def _load_item_embeddings_from_json(self):
+        """逐文件读取未打包的embedding（较慢，建议先运行 python item_store.py 打包）"""
+        item_emb_list = []
+        id2item_id = []
+        if os.path.exists(self.item_embedding_path):
+            from tqdm import tqdm
+
+            for i, file in tqdm(enumerate(os.listdir(self.item_embedding_path))):
+                item_id = os.path.splitext(file)[0]
+                if item_id in self.id2entityid:
+                    id2item_id.append(item_id)
+                    with open(f'{self.item_embedding_path}/{file}', encoding='utf-8') as f:
+                        embed = json.load(f)
+                        item_emb_list.append(embed)
+        else:
+            print(f"警告: 嵌入路径不存在 {self.item_embedding_path}")
+
+        self.id2item_id_arr = np.asarray(id2item_id)
+        self.item_emb_arr = np.asarray(item_emb_list)
+
+    def get_ann_index(self):
+        """加载IVF-PQ索引（python ann_index.py 离线构建），不存在时返回None"""
+        with self._lock:
+            if self._ann_index is None:
+                ann_index_path = get_ann_index_path(self.kg_dataset)
+                if not os.path.exists(ann_index_path):
+                    print(f"警告: ANN索引不存在 {ann_index_path}，使用精确检索")
+                    return None
+                self._ann_index = IVFPQIndex.load(ann_index_path).remap_rows(self.id2item_id_arr)
+            return self._ann_index
+
+    def get_kg_graph(self):
+        """CSR格式的知识图谱（内存映射），只有kg.json时先转换一次，都不存在时返回None"""
+        with self._lock:
+            if self._kg_graph is None:
+                if has_csr_graph(self.kg_dataset_path):
+                    self._kg_graph = CSRGraph.load(self.kg_dataset_path)
+                elif os.path.exists(f"{self.kg_dataset_path}/kg.json"):
+                    print(f"转换 {self.kg_dataset_path}/kg.json 为CSR格式")
+                    convert_kg_json(self.kg_dataset_path)
+                    self._kg_graph = CSRGraph.load(self.kg_dataset_path)
+            return self._kg_graph
+
+    def get_entity_linker(self) -> EntityLinker:
+        """基于entity2id的实体链接器，首次使用时构建"""
+        with self._lock:
+            if self._entity_linker is None:
+                self._entity_linker = EntityLinker(self.entity2id)
+            return self._entity_linker
+
+
+_registry: Dict[str, KGResources] = {}
+_registry_locks: Dict[str, threading.Lock] = {}
+_registry_lock = threading.Lock()
+
+
+def get_kg_resources(kg_dataset) -> KGResources:
+    """返回进程内共享的KGResources，首次调用时加载；多个线程同时首次调用只会加载一次"""
+    resources = _registry.get(kg_dataset)
+    if resources is not None:
+        return resources
+
+    with _registry_lock:
+        lock = _registry_locks.setdefault(kg_dataset, threading.Lock())
+    with lock:
+        if kg_dataset not in _registry:
+            _registry[kg_dataset] = KGResources(kg_dataset)
+        return _registry[kg_dataset]
+
+
+def clear_kg_resources():
+    """清空已加载的资源（数据文件更新后重新加载时使用）"""
+    with _registry_lock:
+        _registry.clear()
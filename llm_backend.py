@@ -0,0 +1,460 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from rate_limit import get_rate_limiter
+from tracing import count, observe, record_usage, span
+
+# LLM后端接口
+#
+# annotate_chat / annotate / UserAgent.generate_response 都通过 chat_completion / embed_completion
+# 调用 get_backend()，请求经过全局限流器（rate_limit.py）的限流与重试：
+# - OpenAIBackend：OpenAI兼容接口（默认）
+# - LocalBackend：本地替身，回复和embedding由请求内容确定性生成，
+#   可配置延迟分布、错误率和速率限制，用于离线压测
+#
+# 流式模式（configure_streaming）下Chat调用改走 chat_stream：记录首token延迟（ttft），
+# stop_when(已生成文本) 返回截断位置时立即关闭流，回复截到该位置，不再等待和支付剩余的completion token
+
+
+@dataclass
+class ChatResult:
+    """一次Chat调用的结果"""
+    content: str
+    usage: Dict = field(default_factory=dict)
+    # 流式调用的首token延迟（秒）和是否因stop_when提前结束
+    ttft: Optional[float] = None
+    stopped: bool = False
+
+
+@dataclass(frozen=True)
+class StopPattern:
+    """
+    流式生成的提前结束条件：正则在已生成文本中第一次匹配的结尾即截断位置
+
+    cache_key 由正则本身决定，结束条件改变时缓存自然失效
+    """
+    pattern: str
+    flags: int = 0
+
+    def __call__(self, text: str) -> Optional[int]:
+        match = re.search(self.pattern, text, self.flags)
+        return match.end() if match else None
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.flags}:{self.pattern}"
+
+
+class LLMError(Exception):
+    """后端调用失败，status_code为HTTP状态码（超时/连接错误为None）"""
+
+    def __init__(self, message, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class LLMBackend:
+    """LLM后端基类"""
+
+    def chat(self, messages: List[Dict], model: str, temperature: float = 0, logit_bias: Optional[Dict] = None,
+             timeout: Optional[float] = 30, **kwargs) -> ChatResult:
+        raise NotImplementedError
+
+    def chat_stream(self, messages: List[Dict], model: str, temperature: float = 0,
+                    logit_bias: Optional[Dict] = None, timeout: Optional[float] = 30,
+                    stop_when: Optional[Callable[[str], Optional[int]]] = None, **kwargs) -> ChatResult:
+        """流式Chat调用，默认退化为非流式调用"""
+        return self.chat(messages, model=model, temperature=temperature, logit_bias=logit_bias, timeout=timeout,
+                         **kwargs)
+
+    def embed(self, inputs: List[str], model: str, timeout: Optional[float] = 30) -> List[List[float]]:
+        raise NotImplementedError
+
+
+DEFAULT_OPENAI_BASE_URL = "https://api.openai.com/v1"
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    OpenAI兼容接口
+
+    密钥取自参数或 OPENAI_API_KEY 环境变量，未设置时报错；
+    API地址取自参数或 OPENAI_BASE_URL 环境变量，默认为OpenAI官方地址
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        if not self.api_key:
+            raise RuntimeError("未设置 OPENAI_API_KEY 环境变量；离线运行请使用 --backend local")
+        self.base_url = base_url or os.environ.get("OPENAI_BASE_URL", DEFAULT_OPENAI_BASE_URL)
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import openai
+                self._client = openai.OpenAI(api_key=self.api_key, base_url=self.base_url)
+            return self._client
+
+    @staticmethod
+    def _convert_error(e):
+        import openai
+        if isinstance(e, openai.APIStatusError):
+            retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+            try:
+                retry_after = float(retry_after) if retry_after is not None else None
+            except ValueError:
+                retry_after = None
+            return LLMError(str(e), status_code=e.status_code, retry_after=retry_after)
+        if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError)):
+            return LLMError(str(e))
+        return e
+
+    def chat(self, messages, model, temperature=0, logit_bias=None, timeout=30, **kwargs):
+        params = dict(model=model, messages=messages, temperature=temperature, timeout=timeout, **kwargs)
+        if logit_bias:
+            params["logit_bias"] = logit_bias
+        try:
+            response = self.client.chat.completions.create(**params)
+        except Exception as e:
+            raise self._convert_error(e) from e
+        usage = response.usage.model_dump() if getattr(response, "usage", None) is not None else {}
+        return ChatResult(content=response.choices[0].message.content, usage=usage)
+
+    def chat_stream(self, messages, model, temperature=0, logit_bias=None, timeout=30, stop_when=None, **kwargs):
+        params = dict(model=model, messages=messages, temperature=temperature, timeout=timeout, stream=True,
+                      stream_options={"include_usage": True}, **kwargs)
+        if logit_bias:
+            params["logit_bias"] = logit_bias
+        start = time.perf_counter()
+        ttft, parts, usage, cut = None, [], {}, None
+        try:
+            stream = self.client.chat.completions.create(**params)
+            try:
+                for chunk in stream:
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage.model_dump()
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    parts.append(chunk.choices[0].delta.content)
+                    if stop_when is not None:
+                        cut = stop_when("".join(parts))
+                        if cut is not None:
+                            break
+            finally:
+                stream.close()
+        except Exception as e:
+            raise self._convert_error(e) from e
+        received = "".join(parts)
+        if cut is None:
+            return ChatResult(content=received, usage=usage, ttft=ttft)
+        # 提前关闭的流没有usage，按已收到的字符数估计
+        prompt_tokens = estimate_tokens(message["content"] for message in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": estimate_tokens([received]),
+                 "total_tokens": prompt_tokens + estimate_tokens([received])}
+        return ChatResult(content=received[:cut], usage=usage, ttft=ttft, stopped=True)
+
+    def embed(self, inputs, model, timeout=30):
+        try:
+            response = self.client.embeddings.create(model=model, input=inputs, timeout=timeout)
+        except Exception as e:
+            raise self._convert_error(e) from e
+        return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+
+def parse_latency(spec) -> Callable[[random.Random], float]:
+    """
+    解析延迟分布（秒）
+
+    支持：数字或数字字符串（固定延迟）、"constant:0.5"、"uniform:0.2,1.0"、
+    "lognormal:0.8,0.5"（中位数, sigma）、"exponential:0.5"（均值），或直接传入 rng -> 秒 的函数
+    """
+    if callable(spec):
+        return spec
+    if isinstance(spec, (int, float)) or ":" not in str(spec):
+        return lambda rng: float(spec)
+    kind, _, args = str(spec).partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "constant":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: values[0] * float(np.exp(rng.gauss(0, values[1])))
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"无法解析的延迟分布: {spec}")
+
+
+LOCAL_TITLES = [
+    "Inception", "The Matrix", "Titanic", "Forrest Gump", "The Godfather", "Interstellar", "Spirited Away",
+    "Amelie", "In the Mood for Love", "Farewell My Concubine", "Infernal Affairs", "Crouching Tiger, Hidden Dragon",
+    "Hero", "Chungking Express", "The Shawshank Redemption", "Pulp Fiction", "Parasite", "Up", "Coco", "Her",
+]
+
+
+class PrefixCacheSimulator:
+    """
+    模拟服务端的prompt前缀缓存：前缀不少于min_tokens时按block_tokens为单位命中
+    （与OpenAI的规则相同：1024 token起，128 token递增），token数按4个字符估算
+
+    Args:
+        capacity: 最多保存的前缀块数，超出时淘汰最久未使用的
+    """
+
+    def __init__(self, min_tokens: int = 1024, block_tokens: int = 128, capacity: int = 100000):
+        self.min_chars = min_tokens * 4
+        self.block_chars = block_tokens * 4
+        self.capacity = capacity
+        self._blocks: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, messages: List[Dict]) -> int:
+        """返回命中缓存的token数，并把本次请求的前缀加入缓存"""
+        text = "".join(f"<{message['role']}>{message['content']}" for message in messages)
+        hasher = hashlib.sha256()
+        cached_chars = 0
+        with self._lock:
+            for end in range(self.block_chars, len(text) + 1, self.block_chars):
+                hasher.update(text[end - self.block_chars:end].encode("utf-8"))
+                if end < self.min_chars:
+                    continue
+                key = hasher.copy().digest()
+                if key in self._blocks:
+                    # 哈希覆盖从开头到end的全部内容，命中即整段前缀相同
+                    self._blocks.move_to_end(key)
+                    cached_chars = end
+                else:
+                    self._blocks[key] = None
+                    if len(self._blocks) > self.capacity:
+                        self._blocks.popitem(last=False)
+        return cached_chars // 4
+
+
+class LocalBackend(LLMBackend):
+    """
+    本地替身后端
+
+    回复内容只由请求内容决定（同样的请求总是得到同样的回复），
+    延迟、错误和限流由独立的随机数生成器模拟，不影响回复内容。
+    prefix_cache 为True时模拟服务端前缀缓存，在usage中返回 prompt_tokens_details.cached_tokens。
+    tokens_per_s 为生成速度（每秒token数），None表示生成不耗时；延迟分布模拟的是首token之前的时间。
+    """
+
+    def __init__(self, latency=0.0, error_rate: float = 0.0, rate_limit_rpm: Optional[int] = None,
+                 embedding_dim: int = 1536, seed: int = 0, prefix_cache: bool = True,
+                 tokens_per_s: Optional[float] = None):
+        self.latency = parse_latency(latency)
+        self.tokens_per_s = tokens_per_s
+        self.error_rate = error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+        self.embedding_dim = embedding_dim
+        self.prefix_cache = PrefixCacheSimulator() if prefix_cache else None
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_times = deque()
+        self.num_requests = 0
+
+    @staticmethod
+    def _digest(payload) -> int:
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return int(hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16], 16)
+
+    def _simulate_request(self):
+        """模拟限流、延迟和随机错误"""
+        with self._lock:
+            self.num_requests += 1
+            now = time.monotonic()
+            if self.rate_limit_rpm:
+                while self._request_times and now - self._request_times[0] >= 60:
+                    self._request_times.popleft()
+                if len(self._request_times) >= self.rate_limit_rpm:
+                    retry_after = 60 - (now - self._request_times[0])
+                    raise LLMError("429 Too Many Requests (local)", status_code=429, retry_after=retry_after)
+                self._request_times.append(now)
+            delay = max(0.0, self.latency(self._rng))
+            failed = self._rng.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            raise LLMError("500 Internal Server Error (local)", status_code=500)
+
+    def _reply(self, messages, digest):
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        n_user_turns = sum(1 for message in messages if message["role"] == "user")
+
+        if system.startswith("You are a recommender"):
+            # 推荐系统：前一轮询问偏好，之后给出10条推荐列表
+            if n_user_turns < 2:
+                return "What kind of movies do you enjoy? Any favourite actors or directors?"
+            start = digest % len(LOCAL_TITLES)
+            titles = [LOCAL_TITLES[(start + i) % len(LOCAL_TITLES)] for i in range(10)]
+            return ("Here are some recommendations:\n" + "\n".join(f"{i + 1}. {t}" for i, t in enumerate(titles))
+                    + "\nLet me know if you would like more details about any of these movies.")
+
+        if messages and messages[-1]["role"] == "assistant":
+            # 用户模拟器：简短回复，部分回复结束对话
+            if re.search(r"^\s*10\.", messages[-1]["content"], re.MULTILINE) and digest % 3 == 0:
+                return "Thank you, that's all I need."
+            title = LOCAL_TITLES[digest % len(LOCAL_TITLES)]
+            return f"I like movies similar to \"{title}\". Anything else?"
+
+        # 其他调用（如get_choice）：返回第一个字符
+        return "A"
+
+    def _usage(self, messages, content):
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+        if self.prefix_cache is not None:
+            usage["prompt_tokens_details"] = {"cached_tokens": self.prefix_cache.lookup(messages)}
+        return usage
+
+    def _generate(self, messages, model, max_tokens=None):
+        """确定性的完整回复，max_tokens按4个字符一个token截断"""
+        digest = self._digest({"model": model, "messages": messages})
+        content = self._reply(messages, digest)
+        return content[:max_tokens * 4] if max_tokens else content
+
+    def chat(self, messages, model, temperature=0, logit_bias=None, timeout=30, **kwargs):
+        self._simulate_request()
+        content = self._generate(messages, model, kwargs.get("max_tokens"))
+        if self.tokens_per_s:
+            time.sleep(len(content) / 4 / self.tokens_per_s)
+        return ChatResult(content=content, usage=self._usage(messages, content))
+
+    def chat_stream(self, messages, model, temperature=0, logit_bias=None, timeout=30, stop_when=None, **kwargs):
+        start = time.perf_counter()
+        self._simulate_request()
+        full = self._generate(messages, model, kwargs.get("max_tokens"))
+        ttft, received, cut = None, "", None
+        # 每个chunk 4个字符（约1个token）
+        for end in range(4, len(full) + 4, 4):
+            if ttft is not None and self.tokens_per_s:
+                time.sleep(1 / self.tokens_per_s)
+            received = full[:end]
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            if stop_when is not None:
+                cut = stop_when(received)
+                if cut is not None:
+                    break
+        content = received[:cut] if cut is not None else received
+        return ChatResult(content=content, usage=self._usage(messages, received), ttft=ttft,
+                          stopped=cut is not None and content != full)
+
+    def embed(self, inputs, model, timeout=30):
+        self._simulate_request()
+        embeds = []
+        for text in inputs:
+            rng = np.random.default_rng(self._digest({"model": model, "input": text}))
+            vec = rng.standard_normal(self.embedding_dim)
+            embeds.append((vec / np.linalg.norm(vec)).tolist())
+        return embeds
+
+
+_backend: Optional[LLMBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> LLMBackend:
+    """返回全局后端，默认OpenAIBackend"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = OpenAIBackend()
+        return _backend
+
+
+def set_backend(backend: LLMBackend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+_streaming = False
+
+
+def configure_streaming(enabled: bool = True):
+    """开启后 chat_completion 中传入 stop_when 的调用改为流式调用"""
+    global _streaming
+    _streaming = enabled
+
+
+def streaming_enabled() -> bool:
+    return _streaming
+
+
+def estimate_tokens(texts) -> int:
+    """请求前粗略估计token数（4个字符约1个token），用于TPM限流"""
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+def _count_retry(attempt, e):
+    count("retries")
+
+
+def chat_completion(messages: List[Dict], model: str, temperature: float = 0, logit_bias: Optional[Dict] = None,
+                    timeout: Optional[float] = 30, stop_when: Optional[Callable[[str], Optional[int]]] = None,
+                    **kwargs) -> ChatResult:
+    """
+    经过限流和重试的Chat调用，重试耗尽后抛出LLMError
+
+    Args:
+        stop_when: 流式模式下的提前结束条件（如 StopPattern），参数为已生成的文本，返回截断位置或None；
+            未开启流式模式时忽略
+    """
+    backend = get_backend()
+    stream = _streaming and stop_when is not None
+
+    def call():
+        if stream:
+            return backend.chat_stream(messages, model=model, temperature=temperature, logit_bias=logit_bias,
+                                       timeout=timeout, stop_when=stop_when, **kwargs)
+        return backend.chat(messages, model=model, temperature=temperature, logit_bias=logit_bias,
+                            timeout=timeout, **kwargs)
+
+    with span("chat_completion", model=model, stream=stream) as current:
+        limiter = get_rate_limiter()
+        if limiter is None:
+            result = call()
+        else:
+            estimated = estimate_tokens(message["content"] for message in messages) + kwargs.get("max_tokens", 256)
+            result = limiter.call(call, estimated_tokens=estimated, on_retry=_count_retry)
+        record_usage(result.usage)
+        if result.ttft is not None:
+            observe("ttft", result.ttft)
+            if current is not None:
+                current.attrs["ttft_ms"] = round(result.ttft * 1000, 3)
+        if result.stopped:
+            count("stream_early_stops")
+        return result
+
+
+def embed_completion(inputs: List[str], model: str, timeout: Optional[float] = 30) -> List[List[float]]:
+    """经过限流和重试的Embedding调用"""
+    backend = get_backend()
+    with span("embed_completion", model=model, inputs=len(inputs)):
+        limiter = get_rate_limiter()
+        if limiter is None:
+            return backend.embed(inputs, model=model, timeout=timeout)
+        return limiter.call(lambda: backend.embed(inputs, model=model, timeout=timeout),
+                            estimated_tokens=estimate_tokens(inputs), on_retry=_count_retry)
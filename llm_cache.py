@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from tracing import count
+
+# LLM回复的持久化缓存（SQLite），多线程/多进程共享同一个文件
+
+DEFAULT_CACHE_PATH = "data/cache/llm_cache.sqlite"
+
+
+class LLMCache:
+    """
+    按 (model, messages, temperature, logit_bias) 缓存Chat API回复
+
+    - 使用SQLite WAL模式，多个线程和进程可以同时读写同一个缓存文件
+    - 超过 max_entries 时按最近访问时间（LRU）淘汰
+    - hits / misses 统计当前进程内的命中情况
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], temperature: float = 0, logit_bias: Optional[Dict] = None,
+                 **extra) -> str:
+        """生成缓存键：请求参数的规范化JSON的sha256"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "logit_bias": {str(k): v for k, v in (logit_bias or {}).items()},
+        }
+        payload.update(extra)
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        except sqlite3.OperationalError:
+            # 更新访问时间失败只影响淘汰顺序
+            pass
+        return row[0]
+
+    def put(self, key: str, value: str):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, last_access) VALUES (?, ?, ?)",
+            (key, value, time.time())
+        )
+        conn.commit()
+        with self._lock:
+            self._puts += 1
+            check = self._puts % 100 == 1
+        if check:
+            self.evict()
+
+    def evict(self):
+        """淘汰最久未访问的条目，使条目数不超过 max_entries"""
+        conn = self._conn()
+        count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        conn.execute(
+            "DELETE FROM llm_cache WHERE key IN "
+            "(SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+            (count - self.max_entries,)
+        )
+        conn.commit()
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM llm_cache")
+        conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+
+_llm_cache: Optional[LLMCache] = None
+_llm_cache_enabled = True
+_llm_cache_config = {"path": DEFAULT_CACHE_PATH, "max_entries": 200000}
+_llm_cache_lock = threading.Lock()
+
+
+def configure_llm_cache(path: Optional[str] = None, max_entries: Optional[int] = None, enabled: bool = True):
+    """修改全局缓存配置，下次调用 get_llm_cache() 时生效"""
+    global _llm_cache, _llm_cache_enabled
+    with _llm_cache_lock:
+        if path is not None:
+            _llm_cache_config["path"] = path
+        if max_entries is not None:
+            _llm_cache_config["max_entries"] = max_entries
+        _llm_cache_enabled = enabled
+        _llm_cache = None
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    """返回全局缓存实例，禁用时返回None"""
+    global _llm_cache
+    if not _llm_cache_enabled:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMCache(**_llm_cache_config)
+        return _llm_cache
+
+
+def cached_chat(create: Callable[[], str], model: str, messages: List[Dict], temperature: float = 0,
+                logit_bias: Optional[Dict] = None, **extra) -> str:
+    """
+    带缓存的Chat API调用
+
+    Args:
+        create: 实际发起请求的函数，返回回复文本；抛出的异常不会被缓存
+        model, messages, temperature, logit_bias: 请求参数，用于生成缓存键
+        extra: 其他影响回复内容的参数（如max_tokens、流式提前结束条件），值为None的不计入缓存键
+
+    Returns:
+        回复文本
+    """
+    cache = get_llm_cache()
+    # 非0温度的回复本身是随机的，不缓存
+    if cache is None or temperature != 0:
+        return create()
+
+    key = cache.make_key(model, messages, temperature, logit_bias,
+                         **{k: v for k, v in extra.items() if v is not None})
+    content = cache.get(key)
+    if content is not None:
+        count("llm_cache_hits")
+        return content
+    count("llm_cache_misses")
+
+    content = create()
+    if content is not None:
+        cache.put(key, content)
+    return content
@@ -1,10 +1,28 @@
 from UserAgent import UserAgent
-from CHATCRS import CHATCRS
+from CHATCRS import CHATCRS, summarize_messages
 import json
-from UserAgent import UserProfile
+from UserAgent import PersonalityProfile, UserProfile
+from llm_cache import configure_llm_cache, get_llm_cache
+from dataset_reader import iter_user_profiles
+from llm_backend import LocalBackend, OpenAIBackend, configure_streaming, set_backend
+from conversation import ConversationState
+from result_sink import JsonFileSink, JsonlResultSink, RunManifest
+from sharding import in_shard, shard_suffix
+from rate_limit import configure_rate_limiter, get_rate_limiter
+from hedging import configure_hedging, get_hedger
+from tracing import configure_tracing, span, start_metrics_server
 import os
+import random
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+# 对话随机种子的基数，每个对话使用 DEFAULT_SEED + 样本id
+DEFAULT_SEED = 42
 
+
+# 一次性读入整个数据文件；模拟流程已改用 dataset_reader.iter_user_profiles 流式读取，
+# 这里保留只作为 benchmarks/bench_suite.py 中解析吞吐的对照基线
 def read_jsonl_file(filename):
     """
     读取JSONL格式文件（每行一个JSON对象）
@@ -38,56 +56,45 @@ def read_jsonl_file(filename):
     return json_objects
 
 
-def extract_specific_fields(json_objects):
+def simulate_with_chatcrs(user_profile: UserProfile, token_budget=None, context_strategy='truncate', seed=None):
     """
-    从每个JSON对象中提取指定字段
+    使用ChatCRS进行模拟对话
 
     Args:
-        json_objects: JSON对象列表
-
-    Returns:
-        list: 提取的数据列表
+        user_profile: 用户画像
+        token_budget: 每次请求推荐系统时上下文的token上限，None表示不限制
+        context_strategy: 超出预算时 'truncate' 丢弃最早的轮次，'summarize' 摘要早期轮次
+        seed: 本对话的随机种子（用户人格等），使用独立的random.Random，不影响并发的其他对话
     """
-    extracted_data = []
-
-    for i, obj in enumerate(json_objects):
-        # 提取需要的字段
-        data = {
-            '序号': i + 1,
-            'goal': obj.get('goal', ''),
-            '用户名': obj.get('user_profile', {}).get('Name', ''),
-            '年龄范围': obj.get('user_profile', {}).get('Age Range', ''),
-            '性别': obj.get('user_profile', {}).get('Gender', ''),
-            '职业': obj.get('user_profile', {}).get('Occupation', ''),
-            '对话轮数': len(obj.get('conversation', [])),
-            '情境': obj.get('situation', '')
-        }
-        extracted_data.append(data)
-
-    return extracted_data
-
-def simulate_with_chatcrs(user_profile: UserProfile):
-    """使用ChatCRS进行模拟对话"""
+    rng = random.Random(seed)
 
     print("创建ChatCRS...")
     chatcrs = CHATCRS(
-        seed=42,  # 设置随机种子
+        seed=seed,  # 设置随机种子
         debug=False,  # 调试模式
         kg_dataset="opendialkg"  # 替换为您的知识图谱数据集名称
     )
 
     # 创建LLM-US模拟器
     print("创建UserAgent模拟器...")
-    useragent = UserAgent(user_profile)
+    useragent = UserAgent(user_profile, personality=PersonalityProfile.random(rng))
 
     print("开始对话模拟")
 
     conversation_history = []
     max_turns = 10
 
+    # 对话状态增量维护，推荐系统每轮直接复用
+    conv_state = ConversationState(
+        token_budget=token_budget,
+        strategy=context_strategy,
+        summarizer=summarize_messages if context_strategy == 'summarize' else None
+    )
+
     # 第一轮：用户开始对话
     user_message = user_profile.query
     conversation_history.append(("user", user_message))
+    conv_state.append(user_message)
     print(f"USER: {user_message}")
 
     for turn in range(max_turns):
@@ -95,29 +102,35 @@ def simulate_with_chatcrs(user_profile: UserProfile):
 
         # 构建对话字典格式（符合CHATGPT类的输入格式）
         conv_dict = {
-            "context": [msg for _, msg in conversation_history if _ == "user" or _ == "system"],
+            "context": conv_state.context,
+            "state": conv_state,
             "rec": []  # 推荐列表，初始为空
         }
 
         # CHATGPT 生成回复
         try:
             # 使用get_conv方法生成对话回复
-            gen_inputs, system_reply = chatcrs.get_conv(conv_dict)
+            with span("get_conv", turn=turn + 1):
+                gen_inputs, system_reply = chatcrs.get_conv(conv_dict)
 
             if not system_reply:
                 print("系统返回空回复")
                 break
 
             conversation_history.append(("system", system_reply))
+            conv_state.append(system_reply)
             print(f"SYSTEM: {system_reply}")
 
         except Exception as e:
+            # 重试耗尽的失败不保存半截对话，交给上层记为失败，下次运行时重新模拟
             print(f"CHATCRS生成回复错误: {e}")
-            break
+            raise
 
         # 用户模拟器回复
-        user_message = useragent.generate_response(system_reply)
+        with span("generate_response", turn=turn + 1):
+            user_message = useragent.generate_response(system_reply)
         conversation_history.append(("user", user_message))
+        conv_state.append(user_message)
         print(f"USER: {user_message}")
 
         # 检查用户是否终止对话
@@ -130,27 +143,11 @@ def simulate_with_chatcrs(user_profile: UserProfile):
     return conversation_history, useragent.get_conversation_summary()
 
 
-if __name__ == '__main__':
-    file_name = "/data/yantingting/crs/PerCRS/data/movie_recommendation_data.txt"
-    json_objects = read_jsonl_file(file_name)
-    sample_num = 100
-    for i in range(sample_num):
-        object = json_objects[i]
-        user_profile = UserProfile(
-            name=object["user_profile"]["Name"],
-            gender=object["user_profile"]["Gender"],
-            age_range=object["user_profile"]["Age Range"],
-            residence=object["user_profile"]["Residence"],
-            liked_movies=object["user_profile"]["Accepted movies"],
-            liked_celebrities=object["user_profile"]["Accepted celebrities"],
-            disliked_movies=object["user_profile"]["Rejected movies"],
-            query=object["conversation"][0].split('] ', 1)[1]
-        )
-        conversation_history, conversation_summary = simulate_with_chatcrs(user_profile)
-
-        #保存对话数据和user信息
-        result_data = {
-            "user_profile": {
+def build_result(sample_id, user_profile: UserProfile, conversation_history, conversation_summary):
+    """对话数据和user信息"""
+    return {
+        "sample_id": sample_id,
+        "user_profile": {
             "name": user_profile.name,
             "gender": user_profile.gender,
             "age_range": user_profile.age_range,
@@ -160,17 +157,176 @@ if __name__ == '__main__':
             "disliked_movies": user_profile.disliked_movies,
             "query": user_profile.query
         },
-            "conversation_summary": conversation_summary,
-            "conversation_history": conversation_history
-        }
+        "conversation_summary": conversation_summary,
+        "conversation_history": conversation_history
+    }
+
+
+def _simulate_and_save(sample_id, user_profile: UserProfile, sink, simulate_kwargs):
+    # 每个对话的种子为 基础种子 + 样本id，结果与并发度和运行顺序无关
+    simulate_kwargs = dict(simulate_kwargs)
+    simulate_kwargs["seed"] = simulate_kwargs.get("seed", DEFAULT_SEED) + sample_id
+    with span("conversation", sample_id=sample_id):
+        conversation_history, conversation_summary = simulate_with_chatcrs(user_profile, **simulate_kwargs)
+        with span("write_result"):
+            sink.write(build_result(sample_id, user_profile, conversation_history, conversation_summary),
+                       sample_id=sample_id)
+    print(f"✓ 样本 {sample_id} 结果已写入")
+    return sample_id
+
 
-        output_dir = "/data/yantingting/crs/PerCRS/data/output"
-        os.makedirs(output_dir, exist_ok=True)
-        output_file = os.path.join(output_dir, f"simulation_{i + 1:03d}_{user_profile.name}.json")
+async def run_simulations_async(samples, sink, concurrency=8, simulate_kwargs=None):
+    """
+    并发运行多个对话模拟
+
+    每个对话内部的轮次仍然严格按顺序执行（一个对话始终在同一个工作线程中运行），
+    不同对话之间并发，最多同时进行 concurrency 个对话。
+
+    Args:
+        samples: (样本id, UserProfile) 列表
+        sink: 结果输出（JsonlResultSink 或 JsonFileSink）
+        concurrency: 最大并发对话数
+        simulate_kwargs: 传给 simulate_with_chatcrs 的其他参数
+
+    Returns:
+        list: 与samples顺序一致，成功的对话为样本id，失败的为None
+    """
+    loop = asyncio.get_running_loop()
+    simulate_kwargs = simulate_kwargs or {}
+    semaphore = asyncio.Semaphore(concurrency)
 
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(result_data, f, ensure_ascii=False, indent=2)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        async def run_one(sample_id, user_profile):
+            async with semaphore:
+                try:
+                    return await loop.run_in_executor(executor, _simulate_and_save, sample_id, user_profile, sink,
+                                                      simulate_kwargs)
+                except Exception as e:
+                    print(f"样本 {sample_id} 对话模拟失败: {e}")
+                    return None
 
-        print(f"✓ 结果已保存到: {output_file}")
+        return await asyncio.gather(*(run_one(sample_id, p) for sample_id, p in samples))
 
 
+def configure_runtime(args, part_index=0):
+    """
+    按命令行参数配置后端、限流、对冲、缓存和追踪
+
+    Returns:
+        (shard, suffix, tracer): 当前进程负责的分片参数、分片标识和Tracer
+    """
+    if args.backend == "local":
+        set_backend(LocalBackend(latency=args.local_latency, error_rate=args.local_error_rate, rate_limit_rpm=args.local_rpm,
+                                 tokens_per_s=args.local_tokens_per_s))
+    else:
+        # 启动时就检查密钥，不等到第一个对话才失败
+        set_backend(OpenAIBackend())
+    configure_streaming(args.stream)
+
+    configure_rate_limiter(rpm=args.rpm, tpm=args.tpm, max_concurrency=args.max_inflight,
+                           max_retries=args.max_retries)
+    configure_hedging(enabled=args.hedge_percentile is not None, percentile=args.hedge_percentile or 95,
+                      max_extra_fraction=args.hedge_budget)
+    configure_llm_cache(path=args.llm_cache, max_entries=args.llm_cache_size, enabled=not args.no_llm_cache)
+
+    # 当前进程负责的分片；文件名带分片标识，不同分片/进程互不干扰
+    shard = dict(shard_index=args.shard_index, num_shards=args.num_shards,
+                 part_index=part_index, num_parts=args.processes)
+    suffix = shard_suffix(**shard)
+
+    tracer = configure_tracing(path=args.trace_file.format(suffix=suffix) if args.trace_file else None)
+    if args.metrics_port:
+        # 进程池模式下每个进程使用 metrics_port + 进程编号
+        start_metrics_server(args.metrics_port + part_index)
+        print(f"指标服务: http://localhost:{args.metrics_port + part_index}/metrics")
+    return shard, suffix, tracer
+
+
+def report_runtime(tracer):
+    """打印缓存、限流、对冲和耗时统计，关闭追踪文件"""
+    llm_cache = get_llm_cache()
+    if llm_cache is not None:
+        print(f"LLM缓存统计: {llm_cache.stats()}")
+    print(f"限流统计: {get_rate_limiter().stats()}")
+    hedger = get_hedger()
+    if hedger is not None:
+        print(f"对冲统计: {hedger.stats()}")
+    tracer.print_summary()
+    tracer.close()
+
+
+def run(args, part_index=0):
+    """按命令行参数运行（一个进程负责一个分片中的一部分）"""
+    shard, suffix, tracer = configure_runtime(args, part_index)
+
+    # 断点续跑：清单中已完成的样本直接跳过
+    manifest = RunManifest(args.manifest or os.path.join(args.output_dir, f"run_manifest{suffix}.txt"))
+    samples = [(sample_id, user_profile) for sample_id, user_profile in
+               iter_user_profiles(args.data_file, start=args.start, limit=args.sample_num)
+               if in_shard(sample_id, **shard) and sample_id not in manifest]
+    print(f"分片{suffix or '（全部）'}: 已完成 {len(manifest)} 个样本，本次运行 {len(samples)} 个")
+
+    if args.sink == "jsonl":
+        output_file = os.path.join(args.output_dir, f"results{suffix}.jsonl" + (".gz" if args.compress else ""))
+        sink = JsonlResultSink(output_file, on_durable=manifest.mark_done)
+    else:
+        sink = JsonFileSink(args.output_dir, on_durable=manifest.mark_done)
+
+    simulate_kwargs = {"token_budget": args.token_budget, "context_strategy": args.context_strategy}
+    with sink:
+        asyncio.run(run_simulations_async(samples, sink, concurrency=max(1, args.concurrency),
+                                          simulate_kwargs=simulate_kwargs))
+    manifest.close()
+    report_runtime(tracer)
+
+
+def build_arg_parser(description="PerCRS 批量对话模拟"):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--data-file", default="/data/yantingting/crs/PerCRS/data/movie_recommendation_data.txt")
+    parser.add_argument("--output-dir", default="/data/yantingting/crs/PerCRS/data/output")
+    parser.add_argument("--sink", choices=["jsonl", "files"], default="jsonl",
+                        help="jsonl 追加写入一个结果文件；files 每个对话一个JSON文件")
+    parser.add_argument("--compress", action="store_true", help="jsonl结果使用gzip压缩")
+    parser.add_argument("--manifest", default=None, help="已完成样本清单，默认 <output-dir>/run_manifest<分片标识>.txt")
+    parser.add_argument("--sample-num", type=int, default=100)
+    parser.add_argument("--start", type=int, default=0, help="从数据文件的第几行开始读取")
+    parser.add_argument("--shard-index", type=int, default=0, help="当前机器负责的分片编号")
+    parser.add_argument("--num-shards", type=int, default=1, help="分片总数（按样本id哈希划分）")
+    parser.add_argument("--processes", type=int, default=1, help="本机启动的进程数，每个进程负责分片的一部分")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的对话数，1表示顺序运行")
+    parser.add_argument("--llm-cache", default="data/cache/llm_cache.sqlite", help="LLM回复缓存文件")
+    parser.add_argument("--llm-cache-size", type=int, default=200000, help="缓存最大条目数（LRU淘汰）")
+    parser.add_argument("--no-llm-cache", action="store_true", help="禁用LLM回复缓存")
+    parser.add_argument("--token-budget", type=int, default=None, help="推荐系统上下文的token上限")
+    parser.add_argument("--context-strategy", choices=["truncate", "summarize"], default="truncate",
+                        help="超出token上限时丢弃或摘要早期轮次")
+    parser.add_argument("--rpm", type=int, default=None, help="每分钟请求数上限（客户端限流）")
+    parser.add_argument("--tpm", type=int, default=None, help="每分钟token数上限（客户端限流）")
+    parser.add_argument("--max-inflight", type=int, default=64, help="同时进行的API请求上限，出现429时自动下调")
+    parser.add_argument("--max-retries", type=int, default=6, help="429/5xx/超时的最大重试次数")
+    parser.add_argument("--hedge-percentile", type=float, default=None,
+                        help="请求超过该百分位延迟仍未返回时补发一次（如95），默认不对冲")
+    parser.add_argument("--hedge-budget", type=float, default=0.05, help="对冲请求占总请求数的上限")
+    parser.add_argument("--trace-file", default=None,
+                        help="每个span一行的JSONL追踪文件，可包含 {suffix} 表示分片标识，如 data/output/trace{suffix}.jsonl")
+    parser.add_argument("--metrics-port", type=int, default=None, help="以Prometheus文本格式在该端口的 /metrics 暴露指标（多进程时依次加1）")
+    parser.add_argument("--backend", choices=["openai", "local"], default="openai",
+                        help="local 使用本地替身后端（离线压测）")
+    parser.add_argument("--local-latency", default="0", help="本地后端延迟分布，如 0.5、uniform:0.2,1.0、lognormal:0.8,0.5")
+    parser.add_argument("--local-error-rate", type=float, default=0.0, help="本地后端随机错误率")
+    parser.add_argument("--local-rpm", type=int, default=None, help="本地后端每分钟请求数上限")
+    parser.add_argument("--local-tokens-per-s", type=float, default=None, help="本地后端生成速度（每秒token数），默认生成不耗时")
+    parser.add_argument("--stream", action="store_true",
+                        help="流式生成：记录首token延迟，推荐列表第10项完整或用户说出结束语时提前结束")
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+
+    if args.processes > 1:
+        # 进程池模式：每个进程各自加载资源、各自写结果文件，最后用 sharding.py merge 合并
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            list(executor.map(run, [args] * args.processes, range(args.processes)))
+    else:
+        run(args)
@@ -0,0 +1,238 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List
+
+from CHATCRS import CHATCRS, summarize_messages
+from UserAgent import PersonalityProfile, UserAgent, UserProfile
+from conversation import ConversationState
+from dataset_reader import iter_user_profiles
+from result_sink import JsonlResultSink, RunManifest
+from sharding import in_shard
+from tracing import span
+from percrs import build_arg_parser, build_result, configure_runtime, report_runtime
+
+# 人格扫描：同一个用户画像在多个人格向量下模拟对话
+#
+# 推荐系统的回复只取决于对话历史，用户模拟器的回复取决于人格和推荐系统的上一条消息（temperature=0）。
+# 所以同一画像的各个人格变体按对话树运行：
+# - 历史相同的变体组成一个分支，每轮只请求一次推荐系统
+# - 每个变体各自请求一次用户模拟器，回复相同的变体留在同一分支，回复不同时分叉（ConversationState.fork）
+# - 用户终止对话或达到最大轮数时，分支中的每个变体各输出一条结果，格式与 percrs.py 相同
+#
+# 用法：python personality_sweep.py --personalities all --data-file data/movie_recommendation_data.txt --sample-num 10
+# 结果写入 <output-dir>/sweep_results.jsonl，清单中的id为 "<样本id>:<人格向量>"，中断后可续跑。
+
+
+def vector_key(vector: List[int]) -> str:
+    """人格向量的字符串形式，如 [1, -1, 1, 1, -1] -> '+-++-'"""
+    return "".join("+" if v > 0 else "-" for v in vector)
+
+
+def parse_personalities(spec: str) -> List[List[int]]:
+    """
+    解析人格向量列表
+
+    Args:
+        spec: 'all' 表示全部32种；否则为逗号分隔的 '+-++-' 形式
+    """
+    if spec == "all":
+        return PersonalityProfile.all_vectors()
+    vectors = []
+    for item in spec.split(","):
+        item = item.strip()
+        if len(item) != 5 or set(item) - {"+", "-"}:
+            raise ValueError(f"人格向量格式应为5个+/-，如 +-++-: {item}")
+        vectors.append([1 if c == "+" else -1 for c in item])
+    return vectors
+
+
+class Branch:
+    """对话树的一个分支：对话历史相同的一组人格变体"""
+
+    def __init__(self, keys: List[str], state: ConversationState, history: List):
+        self.keys = keys
+        self.state = state
+        self.history = history
+
+
+def _user_replies(agents: Dict[str, UserAgent], keys, system_reply, executor):
+    """一个分支中各变体的用户回复，变体之间并行请求"""
+    def reply(key):
+        return agents[key].generate_response(system_reply)
+
+    if executor is None or len(keys) == 1:
+        return [reply(key) for key in keys]
+    # 每个任务使用独立的上下文副本，追踪span仍挂在当前轮次下
+    futures = [executor.submit(contextvars.copy_context().run, reply, key) for key in keys]
+    return [future.result() for future in futures]
+
+
+def simulate_sweep(user_profile: UserProfile, vectors: List[List[int]], token_budget=None,
+                   context_strategy='truncate', max_turns=10, executor=None):
+    """
+    在多个人格向量下模拟同一画像的对话，共享相同的对话前缀
+
+    Returns:
+        (conversations, stats): {人格向量key: (对话历史, 对话摘要)} 和调用次数统计，
+        stats中的 independent_* 为各变体独立运行时需要的调用次数
+    """
+    chatcrs = CHATCRS(seed=42, debug=False, kg_dataset="opendialkg")
+    agents = {vector_key(v): UserAgent(user_profile, personality=PersonalityProfile.from_vector(v)) for v in vectors}
+
+    conv_state = ConversationState(
+        token_budget=token_budget,
+        strategy=context_strategy,
+        summarizer=summarize_messages if context_strategy == 'summarize' else None
+    )
+    conv_state.append(user_profile.query)
+
+    stats = {"variants": len(agents), "branches": 1, "crs_calls": 0, "user_calls": 0,
+             "independent_crs_calls": 0, "independent_user_calls": 0}
+    conversations = {}
+
+    def finish(branch):
+        for key in branch.keys:
+            conversations[key] = (list(branch.history), agents[key].get_conversation_summary())
+
+    frontier = [Branch(list(agents), conv_state, [("user", user_profile.query)])]
+    for turn in range(max_turns):
+        next_frontier = []
+        for branch in frontier:
+            conv_dict = {"context": branch.state.context, "state": branch.state, "rec": []}
+            with span("get_conv", turn=turn + 1, variants=len(branch.keys)):
+                _, system_reply = chatcrs.get_conv(conv_dict)
+            stats["crs_calls"] += 1
+            stats["independent_crs_calls"] += len(branch.keys)
+
+            if not system_reply:
+                print("系统返回空回复")
+                finish(branch)
+                continue
+            branch.history.append(("system", system_reply))
+            branch.state.append(system_reply)
+
+            with span("generate_response", turn=turn + 1, variants=len(branch.keys)):
+                replies = _user_replies(agents, branch.keys, system_reply, executor)
+            stats["user_calls"] += len(branch.keys)
+            stats["independent_user_calls"] += len(branch.keys)
+
+            # 按回复分组，最后一组沿用原来的状态，其他组复制一份
+            groups: Dict[str, List[str]] = {}
+            for key, reply in zip(branch.keys, replies):
+                groups.setdefault(reply, []).append(key)
+            stats["branches"] += len(groups) - 1
+            for index, (reply, keys) in enumerate(groups.items()):
+                state = branch.state if index == len(groups) - 1 else branch.state.fork()
+                state.append(reply)
+                child = Branch(keys, state, branch.history + [("user", reply)])
+                if agents[keys[0]].is_conversation_ended(reply):
+                    finish(child)
+                else:
+                    next_frontier.append(child)
+        frontier = next_frontier
+        if not frontier:
+            break
+
+    for branch in frontier:
+        finish(branch)
+    return conversations, stats
+
+
+def _sweep_and_save(sample_id, user_profile, vectors, sink, simulate_kwargs):
+    with span("conversation", sample_id=sample_id):
+        conversations, stats = simulate_sweep(user_profile, vectors, **simulate_kwargs)
+        with span("write_result"):
+            for key, (conversation_history, conversation_summary) in conversations.items():
+                result = build_result(sample_id, user_profile, conversation_history, conversation_summary)
+                sink.write(result, sample_id=f"{sample_id}:{key}")
+    calls, independent = stats["crs_calls"] + stats["user_calls"], \
+        stats["independent_crs_calls"] + stats["independent_user_calls"]
+    print(f"✓ 样本 {sample_id}: {stats['variants']} 个人格变体，{stats['branches']} 个分支，"
+          f"LLM调用 {calls} 次（独立运行需 {independent} 次）")
+    return stats
+
+
+async def run_sweeps_async(jobs, sink, concurrency=4, variant_concurrency=8, simulate_kwargs=None):
+    """
+    并发运行多个画像的人格扫描
+
+    Args:
+        jobs: (样本id, UserProfile, 人格向量列表) 列表
+        concurrency: 同时进行的画像数
+        variant_concurrency: 每个分支中同时请求用户模拟器的变体数
+
+    Returns:
+        list: 每个画像的调用次数统计，失败的为None
+    """
+    loop = asyncio.get_running_loop()
+    simulate_kwargs = dict(simulate_kwargs or {})
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            ThreadPoolExecutor(max_workers=max(1, variant_concurrency)) as variant_executor:
+        simulate_kwargs["executor"] = variant_executor if variant_concurrency > 1 else None
+
+        async def run_one(sample_id, user_profile, vectors):
+            async with semaphore:
+                try:
+                    return await loop.run_in_executor(executor, _sweep_and_save, sample_id, user_profile, vectors,
+                                                      sink, simulate_kwargs)
+                except Exception as e:
+                    print(f"样本 {sample_id} 人格扫描失败: {e}")
+                    return None
+
+        return await asyncio.gather(*(run_one(*job) for job in jobs))
+
+
+def run(args, part_index=0):
+    shard, suffix, tracer = configure_runtime(args, part_index)
+    vectors = parse_personalities(args.personalities)
+
+    # 断点续跑：只运行清单中还没有完成的 (样本, 人格) 组合
+    manifest = RunManifest(args.manifest or os.path.join(args.output_dir, f"sweep_manifest{suffix}.txt"))
+    jobs = []
+    for sample_id, user_profile in iter_user_profiles(args.data_file, start=args.start, limit=args.sample_num):
+        if not in_shard(sample_id, **shard):
+            continue
+        todo = [v for v in vectors if f"{sample_id}:{vector_key(v)}" not in manifest]
+        if todo:
+            jobs.append((sample_id, user_profile, todo))
+    print(f"分片{suffix or '（全部）'}: {len(jobs)} 个画像，每个最多 {len(vectors)} 个人格变体")
+
+    output_file = os.path.join(args.output_dir, f"sweep_results{suffix}.jsonl" + (".gz" if args.compress else ""))
+    simulate_kwargs = {"token_budget": args.token_budget, "context_strategy": args.context_strategy,
+                       "max_turns": args.max_turns}
+    start = time.time()
+    with JsonlResultSink(output_file, on_durable=manifest.mark_done) as sink:
+        results = asyncio.run(run_sweeps_async(jobs, sink, concurrency=max(1, args.concurrency),
+                                               variant_concurrency=args.variant_concurrency,
+                                               simulate_kwargs=simulate_kwargs))
+    manifest.close()
+
+    results = [stats for stats in results if stats is not None]
+    calls = sum(s["crs_calls"] + s["user_calls"] for s in results)
+    independent = sum(s["independent_crs_calls"] + s["independent_user_calls"] for s in results)
+    if independent:
+        print(f"人格扫描: {len(results)} 个画像，LLM调用 {calls} 次，独立运行需 {independent} 次，"
+              f"节省 {1 - calls / independent:.1%}，用时 {time.time() - start:.1f}s")
+    report_runtime(tracer)
+
+
+if __name__ == '__main__':
+    parser = build_arg_parser("PerCRS 人格扫描（共享对话前缀）")
+    parser.add_argument("--personalities", default="all",
+                        help="人格向量：all 表示全部32种，或逗号分隔的 +-++- 形式")
+    parser.add_argument("--max-turns", type=int, default=10, help="每个对话的最大轮数")
+    parser.add_argument("--variant-concurrency", type=int, default=8, help="同一分支中并行请求用户模拟器的变体数")
+    args = parser.parse_args()
+    if args.sink != "jsonl":
+        parser.error("人格扫描只支持 --sink jsonl（结果id为 样本id:人格向量）")
+
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            list(executor.map(run, [args] * args.processes, range(args.processes)))
+    else:
+        run(args)
@@ -0,0 +1,215 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# 客户端限流与重试
+#
+# - TokenBucket：每分钟请求数（RPM）和每分钟token数（TPM）两个令牌桶
+# - AdaptiveConcurrency：AIMD并发控制，出现429时并发减半，持续成功后逐步加一
+# - RateLimiter.call：可重试错误（429、5xx、超时/连接错误）按带抖动的指数退避重试，
+#   有Retry-After时按服务端要求等待，并让所有工作线程一起暂停
+
+
+class TokenBucket:
+    """令牌桶，rate_per_minute 为每分钟补充的令牌数，capacity 默认等于一分钟的量"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1) -> float:
+        """取走amount个令牌，不足时阻塞等待；返回等待的秒数"""
+        # 超过桶容量的请求只要求桶满，否则永远等不到
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def adjust(self, amount: float):
+        """按实际用量修正（amount为正表示多用了令牌，可以使余额为负）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+
+class AdaptiveConcurrency:
+    """AIMD并发上限：limit 在 [minimum, maximum] 之间调整"""
+
+    def __init__(self, maximum: int = 64, minimum: int = 1, increase_after: int = 10):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.increase_after = increase_after
+        self.limit = maximum
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+
+
+def is_retryable(e: Exception) -> bool:
+    """429、5xx 和没有状态码的网络错误（超时、连接失败）可以重试"""
+    if not hasattr(e, "status_code"):
+        return False
+    status_code = e.status_code
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+class RateLimiter:
+    """
+    Chat/Embedding 调用共用的限流器
+
+    Args:
+        rpm: 每分钟请求数上限，None表示不限制
+        tpm: 每分钟token数上限，None表示不限制
+        max_concurrency / min_concurrency: 自适应并发的上下限
+        max_retries: 最多重试次数
+        base_delay / max_delay: 指数退避的初始和最大等待（秒）
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None, max_concurrency: int = 64,
+                 min_concurrency: int = 1, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.rpm_bucket = TokenBucket(rpm) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm else None
+        self.concurrency = AdaptiveConcurrency(maximum=max_concurrency, minimum=min_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._pause_until = 0.0
+        self._rng = random.Random()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            # 在服务端要求的时间上加少量抖动，避免所有线程同时恢复
+            return retry_after + self._rng.uniform(0, min(1.0, self.base_delay))
+        # full jitter
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _wait_pause(self):
+        while True:
+            with self._lock:
+                wait = self._pause_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def call(self, fn: Callable, estimated_tokens: int = 0, on_retry: Optional[Callable] = None):
+        """
+        在限流和重试下调用fn
+
+        Args:
+            fn: 无参数的调用，返回值带 usage 字典时用实际token数修正TPM
+            estimated_tokens: 请求前预估的token数
+            on_retry: 每次重试前以 (attempt, exception) 调用
+
+        Returns:
+            fn的返回值；重试耗尽或错误不可重试时抛出最后一次的异常
+        """
+        attempt = 0
+        while True:
+            self._wait_pause()
+            self.concurrency.acquire()
+            try:
+                if self.rpm_bucket is not None:
+                    self.rpm_bucket.acquire(1)
+                if self.tpm_bucket is not None and estimated_tokens:
+                    self.tpm_bucket.acquire(estimated_tokens)
+                with self._lock:
+                    self.requests += 1
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                retry_after = getattr(e, "retry_after", None)
+                if e.status_code == 429:
+                    self.concurrency.on_throttle()
+                    with self._lock:
+                        self.throttled += 1
+                        if retry_after is not None:
+                            self._pause_until = max(self._pause_until, time.monotonic() + retry_after)
+                delay = self._backoff(attempt, retry_after)
+                with self._lock:
+                    self.retries += 1
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                attempt += 1
+            else:
+                self.concurrency.on_success()
+                usage = getattr(result, "usage", None)
+                if self.tpm_bucket is not None and isinstance(usage, dict) and usage.get("total_tokens"):
+                    self.tpm_bucket.adjust(usage["total_tokens"] - estimated_tokens)
+                return result
+            finally:
+                self.concurrency.release()
+            time.sleep(delay)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "failures": self.failures,
+                "concurrency_limit": self.concurrency.limit,
+            }
+
+
+_rate_limiter: Optional[RateLimiter] = RateLimiter()
+_rate_limiter_lock = threading.Lock()
+
+
+def configure_rate_limiter(enabled: bool = True, **kwargs):
+    """替换全局限流器，参数同 RateLimiter；enabled=False 时不限流也不重试"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = RateLimiter(**kwargs) if enabled else None
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    return _rate_limiter
@@ -0,0 +1,248 @@
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Callable, Iterable, Iterator, List, Optional, Set
+
+# 批量模拟的结果输出与断点续跑
+#
+# - RunManifest：追加写入已完成的样本id，重新运行时跳过
+# - JsonlResultSink：所有对话追加写入同一个JSONL文件（可选gzip），定期fsync
+# - JsonFileSink：每个对话一个JSON文件（原来的输出格式）
+#
+# 结果真正落盘（fsync）之后才通过 on_durable 回调写入清单，清单中的id一定有对应结果。
+
+
+class RunManifest:
+    """记录已完成样本id的追加式清单文件，每行一个id"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.done: Set[str] = set()
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    # 没有换行符的末行是中断时写了一半的记录
+                    if line.endswith("\n") and line.strip():
+                        self.done.add(line.strip())
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def __contains__(self, sample_id):
+        return str(sample_id) in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def mark_done(self, sample_ids: Iterable):
+        """结果落盘之后再调用，保证清单中的id一定有对应结果"""
+        sample_ids = [str(sample_id) for sample_id in sample_ids]
+        if not sample_ids:
+            return
+        with self._lock:
+            self._file.write("".join(f"{sample_id}\n" for sample_id in sample_ids))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.done.update(sample_ids)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _read_gzip_prefix(path):
+    """
+    读取gzip文件中能完整解压的内容
+
+    Returns:
+        (data, complete): 截到最后一个换行的解压内容，以及文件是否由完整的member组成
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    chunks, complete = [], True
+    while raw:
+        decompressor = zlib.decompressobj(31)
+        try:
+            chunks.append(decompressor.decompress(raw))
+        except zlib.error:
+            complete = False
+            break
+        if not decompressor.eof:
+            # 中断的写入：最后一个member没有结尾，已解压的部分止于最后一次 Z_SYNC_FLUSH 附近
+            complete = False
+            break
+        raw = decompressor.unused_data
+    data = b"".join(chunks)
+    if not data.endswith(b"\n"):
+        complete = False
+        data = data[:data.rfind(b"\n") + 1]
+    return data, complete
+
+
+def _repair_gzip(path):
+    """中断后续跑前修复gzip结果文件：把能读出的完整记录重写为一个完整的member，丢弃损坏的末尾"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    data, complete = _read_gzip_prefix(path)
+    if complete:
+        return
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(data)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    num_records = data.count(b"\n")
+    print(f"修复了中断的压缩结果文件 {path}，保留 {num_records} 条记录")
+
+
+def _repair_plain(path, chunk_size=1 << 16):
+    """中断后续跑前修复未压缩的结果文件：截掉最后一个换行之后写了一半的记录"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        # 从文件末尾向前按块查找最后一个换行
+        while pos > 0:
+            start = max(0, pos - chunk_size)
+            f.seek(start)
+            chunk = f.read(pos - start)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos == end:
+            return
+        f.truncate(pos)
+        f.flush()
+        os.fsync(f.fileno())
+    print(f"修复了中断的结果文件 {path}，丢弃末尾不完整的 {end - pos} 字节")
+
+
+class JsonlResultSink:
+    """
+    追加式JSONL结果文件，线程安全
+
+    Args:
+        path: 输出文件，以 .gz 结尾时使用gzip压缩
+        fsync_every: 每写入多少条记录fsync一次
+        fsync_interval: 距上次fsync超过多少秒时fsync
+        on_durable: fsync之后以本次落盘的样本id列表调用，通常为 RunManifest.mark_done
+    """
+
+    def __init__(self, path, fsync_every=20, fsync_interval=10.0,
+                 on_durable: Optional[Callable[[List], None]] = None):
+        self.path = path
+        self.on_durable = on_durable
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.compressed = self.path.endswith(".gz")
+        if self.compressed:
+            # 上次运行中断时最后一个member没有结尾，直接在后面追加会使整个文件无法解压
+            _repair_gzip(self.path)
+        else:
+            # 上次运行中断时最后一行可能只写了一半，直接追加会把下一条记录接在这一行后面
+            _repair_plain(self.path)
+
+        self._raw = open(self.path, 'ab')
+        # gzip追加时新建一个member，读取时各member自动拼接
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='ab') if self.compressed else self._raw
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_sync = time.monotonic()
+
+    def write(self, record: dict, sample_id=None):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            self._file.write(line)
+            self._pending.append(sample_id)
+            if len(self._pending) >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        if self.compressed:
+            # 刷新压缩缓冲区，使已写入的记录可以被完整解压
+            self._file.flush(zlib.Z_SYNC_FLUSH)
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        durable = [sample_id for sample_id in self._pending if sample_id is not None]
+        self._pending = []
+        self._last_sync = time.monotonic()
+        if self.on_durable is not None:
+            self.on_durable(durable)
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            if self.compressed:
+                self._file.close()
+            self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonFileSink:
+    """每个对话写一个缩进的JSON文件，文件名包含样本id，不会因重名覆盖"""
+
+    def __init__(self, output_dir, on_durable: Optional[Callable[[List], None]] = None):
+        self.output_dir = output_dir
+        self.on_durable = on_durable
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def write(self, record: dict, sample_id=None):
+        name = record.get("user_profile", {}).get("name", "")
+        output_file = os.path.join(self.output_dir, f"simulation_{sample_id:06d}_{name}.json")
+        tmp_file = output_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, output_file)
+        if self.on_durable is not None and sample_id is not None:
+            self.on_durable([sample_id])
+        return output_file
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_jsonl_results(path) -> Iterator[dict]:
+    """读取结果文件，忽略中断时写了一半的末尾记录"""
+    opener = gzip.open if path.endswith(".gz") else open
+    try:
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        # gzip文件末尾的member不完整或已损坏，读到损坏处为止
+        return
@@ -0,0 +1,126 @@
+import argparse
+import glob
+import hashlib
+import os
+import sys
+from typing import Dict, Iterable, List, Optional
+
+from result_sink import JsonlResultSink, read_jsonl_results
+
+# 模拟任务的确定性分片与分片结果合并
+#
+# 样本按样本id的哈希分到 num_shards 个分片（跨机器），每个分片内可再按 num_parts 分给多个进程。
+# 同一个样本id在任何机器、任何运行中都落在同一个分片/进程，重跑与续跑不会重复或遗漏。
+#
+# 合并：python sharding.py merge --output-dir data/output --data-file data/movie_recommendation_data.txt --start 0 --sample-num 100
+# （--start/--sample-num 与模拟运行时相同，不指定 --sample-num 时预期数据文件中的全部样本）
+
+
+def _hash(sample_id) -> int:
+    return int(hashlib.md5(str(sample_id).encode("utf-8")).hexdigest()[:16], 16)
+
+
+def shard_of(sample_id, num_shards: int) -> int:
+    return _hash(sample_id) % num_shards
+
+
+def part_of(sample_id, num_shards: int, num_parts: int) -> int:
+    """分片内的进程编号，与 shard_of 使用哈希的不同部分，分片内均匀划分"""
+    return (_hash(sample_id) // num_shards) % num_parts
+
+
+def in_shard(sample_id, shard_index=0, num_shards=1, part_index=0, num_parts=1) -> bool:
+    return shard_of(sample_id, num_shards) == shard_index and \
+        part_of(sample_id, num_shards, num_parts) == part_index
+
+
+def shard_suffix(shard_index=0, num_shards=1, part_index=0, num_parts=1) -> str:
+    """输出文件名中的分片标识，不分片时为空"""
+    suffix = ""
+    if num_shards > 1:
+        suffix += f".shard-{shard_index:03d}-of-{num_shards:03d}"
+    if num_parts > 1:
+        suffix += f".part-{part_index:03d}-of-{num_parts:03d}"
+    return suffix
+
+
+def find_result_files(output_dir) -> List[str]:
+    """输出目录下所有分片的JSONL结果文件"""
+    files = glob.glob(os.path.join(output_dir, "results*.jsonl")) + \
+        glob.glob(os.path.join(output_dir, "results*.jsonl.gz"))
+    return sorted(files)
+
+
+def merge_results(result_files: Iterable[str], expected_ids: Optional[Iterable[int]] = None) -> Dict:
+    """
+    合并多个分片的结果
+
+    同一样本出现多次（中断后重跑）时保留最后一次写入的结果。
+
+    Returns:
+        dict: records 按样本id排序的结果，duplicates 重复的样本id，missing 缺失的样本id，unexpected 不在预期中的样本id
+    """
+    records = {}
+    duplicates = set()
+    for result_file in result_files:
+        for record in read_jsonl_results(result_file):
+            sample_id = record["sample_id"]
+            if sample_id in records:
+                duplicates.add(sample_id)
+            records[sample_id] = record
+
+    missing, unexpected = [], []
+    if expected_ids is not None:
+        expected_ids = set(expected_ids)
+        missing = sorted(expected_ids - records.keys())
+        unexpected = sorted(records.keys() - expected_ids)
+
+    return {
+        "records": [records[sample_id] for sample_id in sorted(records)],
+        "duplicates": sorted(duplicates),
+        "missing": missing,
+        "unexpected": unexpected,
+    }
+
+
+def expected_sample_ids(data_file, start=0, limit=None, exclude_goal_keyword="Greetings") -> List[int]:
+    """与 percrs.py 相同的筛选条件下应当运行的样本id"""
+    from dataset_reader import exclude_goal, iter_records
+
+    predicate = exclude_goal(exclude_goal_keyword) if exclude_goal_keyword else None
+    return [line_num for line_num, _ in iter_records(data_file, start=start, limit=limit, predicate=predicate)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="合并分片结果")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge_parser = subparsers.add_parser("merge")
+    merge_parser.add_argument("--output-dir", required=True, help="分片结果所在目录")
+    merge_parser.add_argument("--merged-file", default=None, help="合并输出，默认 <output-dir>/merged.jsonl")
+    merge_parser.add_argument("--data-file", default=None, help="提供时检查缺失的样本")
+    merge_parser.add_argument("--start", type=int, default=0, help="与模拟运行时的 --start 相同")
+    merge_parser.add_argument("--sample-num", type=int, default=None,
+                              help="与模拟运行时的 --sample-num 相同，默认预期数据文件中的全部样本")
+    merge_parser.add_argument("--allow-gaps", action="store_true", help="有缺失样本时仍然返回0")
+    args = parser.parse_args()
+
+    result_files = find_result_files(args.output_dir)
+    expected = expected_sample_ids(args.data_file, args.start, args.sample_num) if args.data_file else None
+    merged = merge_results(result_files, expected)
+
+    merged_file = args.merged_file or os.path.join(args.output_dir, "merged.jsonl")
+    if os.path.exists(merged_file):
+        os.remove(merged_file)
+    with JsonlResultSink(merged_file, fsync_every=1000) as sink:
+        for record in merged["records"]:
+            sink.write(record)
+
+    print(f"合并 {len(result_files)} 个文件，共 {len(merged['records'])} 个样本 -> {merged_file}")
+    if merged["duplicates"]:
+        print(f"重复样本（保留最后一次结果）: {len(merged['duplicates'])} 个，{merged['duplicates'][:20]}")
+    if merged["unexpected"]:
+        print(f"不在预期中的样本: {len(merged['unexpected'])} 个，{merged['unexpected'][:20]}")
+    if merged["missing"]:
+        print(f"缺失样本: {len(merged['missing'])} 个，{merged['missing'][:20]}")
+        if not args.allow_gaps:
+            sys.exit(1)
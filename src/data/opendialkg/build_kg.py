@@ -1,6 +1,11 @@
 import json
+import os
+import sys
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from kg_graph import CSRGraph
+
 kg = defaultdict(list)
 entity2id = defaultdict(lambda: len(entity2id))
 relation2id = defaultdict(lambda: len(relation2id))
@@ -27,6 +32,9 @@ with open('entity2id.json', 'w', encoding='utf-8') as f:
 with open('relation2id.json', 'w', encoding='utf-8') as f:
     json.dump(relation2id, f, ensure_ascii=False)
 
+# 同一张图的CSR格式（kg_indptr/kg_indices/kg_relations.npy），可内存映射，见 kg_graph.py
+CSRGraph.from_adjacency(kg, num_nodes=len(entity2id), num_relations=len(relation2id)).save('.')
+
 item_ids = set()
 with open('data.jsonl', encoding='utf-8') as f:
     for line in f:
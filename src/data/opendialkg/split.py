@@ -1,21 +1,27 @@
 import json
 import random
-from copy import copy
+from array import array
 from tqdm import tqdm
 
+# 流式划分数据集
+#
+# 每个样本只记录 (dialog_id, turn_id) 引用，上下文需要时由 build_sample 从对话中重建，
+# 不再在每个assistant轮次复制四个不断增长的上下文列表；data.jsonl 在读取的同时写出。
+# 划分结果与逐条保存样本时相同：random.sample / random.shuffle 只依赖样本数和随机状态。
 
-def process_data(data_file_path):
-    global dialog_id
 
-    dialog_list = []
-    data_list = []
+def iter_dialogs(data_file_path, dialog_id):
+    """
+    逐行读取对话
+
+    Yields:
+        (dialog, turn_ids): 对话（每个turn带turn_id）及其中可作为样本的assistant轮次的turn_id
+    """
     with open(data_file_path, encoding='utf-8') as f:
         for line in tqdm(f):
             line = json.loads(line)
-            context_text_list = []
-            context_text_template_list = []
-            context_entity_list = []
-            context_item_list = []
+            has_context = False
+            turn_ids = []
             turn_id = 0
 
             dialog = {'dialog_id': dialog_id, 'dialog': []}
@@ -24,114 +30,101 @@ def process_data(data_file_path):
                 turn['turn_id'] = turn_id
                 dialog['dialog'].append(turn)
 
-                text = turn['text']
-                text_template = turn['text_template']
-                role = turn['role']
-                # item = [title2id[title] for title in turn['item']]
-                item = turn['item']
-                entity = turn['entity']
-
-                if role == 'assistant':
+                if turn['role'] == 'assistant':
                     flag = True
-                    if len(context_text_list) == 0:
-                        context_text_list.append('')
+                    if not has_context:
+                        # assistant先开口时上下文以空字符串开头，占用一个turn_id
                         turn_id += 1
                         flag = False
 
-                    if len(item) > 0 and flag is True:
-                        data = {
-                            'dialog_id': dialog_id,
-                            'turn_id': turn_id,
-                            'context': copy(context_text_list),
-                            'context_template': copy(context_text_template_list),
-                            'context_entity': copy(context_entity_list),
-                            'context_item': copy(context_item_list),
-                            'resp': text,
-                            'item': item
-                        }
-                        data_list.append(data)
-                        # out_file.write(json.dumps(data, ensure_ascii=False) + '\n')
-
-                context_text_list.append(text)
-                context_text_template_list.append(text_template)
-                context_entity_list.extend(entity)
-                context_item_list.extend(item)
+                    if len(turn['item']) > 0 and flag is True:
+                        turn_ids.append(turn_id)
+
+                has_context = True
                 turn_id += 1
 
+            yield dialog, turn_ids
             dialog_id += 1
-            dialog_list.append(dialog)
 
-    return data_list, dialog_list
 
+def build_sample(dialog, turn_id):
+    """由对话重建 (dialog_id, turn_id) 对应的样本，字段与原来的逐条样本相同"""
+    context_text_list = []
+    context_text_template_list = []
+    context_entity_list = []
+    context_item_list = []
+    current_turn_id = 0
+
+    for turn in dialog['dialog']:
+        if turn['role'] == 'assistant':
+            if len(context_text_list) == 0:
+                context_text_list.append('')
+                current_turn_id += 1
+
+            if current_turn_id == turn_id:
+                return {
+                    'dialog_id': dialog['dialog_id'],
+                    'turn_id': turn_id,
+                    'context': context_text_list,
+                    'context_template': context_text_template_list,
+                    'context_entity': context_entity_list,
+                    'context_item': context_item_list,
+                    'resp': turn['text'],
+                    'item': turn['item']
+                }
+
+        context_text_list.append(turn['text'])
+        context_text_template_list.append(turn['text_template'])
+        context_entity_list.extend(turn['entity'])
+        context_item_list.extend(turn['item'])
+        current_turn_id += 1
+
+    raise KeyError(f"{dialog['dialog_id']}_{turn_id}")
+
+
+def process_data(data_file_path, out_file, dialog_ids, turn_ids, dialog_id=0):
+    """读取一个领域的对话，边读边写入out_file，样本引用追加到dialog_ids/turn_ids，返回下一个dialog_id"""
+    for dialog, sample_turn_ids in iter_dialogs(data_file_path, dialog_id):
+        out_file.write(json.dumps(dialog, ensure_ascii=False) + '\n')
+        for turn_id in sample_turn_ids:
+            dialog_ids.append(dialog['dialog_id'])
+            turn_ids.append(turn_id)
+        dialog_id += 1
+    return dialog_id
 
-if __name__ == '__main__':
-    dialog_id = 0
 
+if __name__ == '__main__':
     random.seed(42)
 
-    with open('id2info.json', encoding='utf-8') as f:
-        id2info = json.load(f)
-    with open('title2id.json', encoding='utf-8') as f:
-        title2id = json.load(f)
-
-    data_file_path = 'dialog_movie.jsonl'
-    movie_data_list, movie_dialog_list = process_data(data_file_path)
+    # 样本引用：第i个样本为 (dialog_ids[i], turn_ids[i])
+    dialog_ids, turn_ids = array('q'), array('l')
+    with open('data.jsonl', 'w', encoding='utf-8') as f:
+        dialog_id = process_data('dialog_movie.jsonl', f, dialog_ids, turn_ids)
+        process_data('dialog_Books.jsonl', f, dialog_ids, turn_ids, dialog_id=dialog_id)
 
-    data_file_path = 'dialog_Books.jsonl'
-    book_data_list, book_dialog_list = process_data(data_file_path)
+    num_data = len(dialog_ids)
 
-    all_dialog_list = movie_dialog_list + book_dialog_list
-    with open('data.jsonl', 'w', encoding='utf-8') as f:
-        for dialog in all_dialog_list:
-            f.write(json.dumps(dialog, ensure_ascii=False) + '\n')
+    def data_id(i):
+        return f"{dialog_ids[i]}_{turn_ids[i]}"
 
-    all_data_list = movie_data_list + book_data_list
-    test_data_list = random.sample(all_data_list, int(len(all_data_list) * 0.15))
-    test_data_list = sorted(test_data_list, key=lambda x: x['dialog_id'])
+    test_index_list = random.sample(range(num_data), int(num_data * 0.15))
+    test_index_list = sorted(test_index_list, key=lambda i: dialog_ids[i])
 
-    print(len(test_data_list))
+    print(len(test_index_list))
 
-    test_data_dialog_id_set = {f"{data['dialog_id']}_{data['turn_id']}" for data in test_data_list}
-    rest_data_list = []
-    for data in all_data_list:
-        if f"{data['dialog_id']}_{data['turn_id']}" not in test_data_dialog_id_set:
-            rest_data_list.append(data)
-    assert len(rest_data_list) + len(test_data_list) == len(all_data_list)
+    test_index_set = set(test_index_list)
+    rest_index_list = [i for i in range(num_data) if i not in test_index_set]
+    assert len(rest_index_list) + len(test_index_list) == num_data
 
-    random.shuffle(rest_data_list)
-    train_data_list, valid_data_list = rest_data_list[int(0.15 * len(all_data_list)):], rest_data_list[:int(0.15 * len(all_data_list))]
-    assert len(valid_data_list) == len(test_data_list)
+    random.shuffle(rest_index_list)
+    train_index_list, valid_index_list = rest_index_list[int(0.15 * num_data):], rest_index_list[:int(0.15 * num_data)]
+    assert len(valid_index_list) == len(test_index_list)
 
-    train_data_id_list = [f"{data['dialog_id']}_{data['turn_id']}" for data in train_data_list]
     with open('train_data_id.json', 'w', encoding='utf-8') as f:
-        json.dump(train_data_id_list, f, ensure_ascii=False)
+        json.dump([data_id(i) for i in train_index_list], f, ensure_ascii=False)
 
-    valid_data_id_list = [f"{data['dialog_id']}_{data['turn_id']}" for data in valid_data_list]
     with open('valid_data_id.json', 'w', encoding='utf-8') as f:
-        json.dump(valid_data_id_list, f, ensure_ascii=False)
+        json.dump([data_id(i) for i in valid_index_list], f, ensure_ascii=False)
 
-    test_data_id_list = [f"{data['dialog_id']}_{data['turn_id']}" for data in test_data_list]
     with open('test_data_id.json', 'w', encoding='utf-8') as f:
-        json.dump(test_data_id_list, f, ensure_ascii=False)
-
-    # with open('train_data.jsonl', 'w', encoding='utf-8') as f:
-    #     for data in train_data_list:
-    #         f.write(json.dumps(data, ensure_ascii=False) + '\n')
-    #
-    # with open('valid_data.jsonl', 'w', encoding='utf-8') as f:
-    #     for data in valid_data_list:
-    #         f.write(json.dumps(data, ensure_ascii=False) + '\n')
-    #
-    # with open('test_data.jsonl', 'w', encoding='utf-8') as f:
-    #     for data in test_data_list:
-    #         f.write(json.dumps(data, ensure_ascii=False) + '\n')
-
-    # cnt = 0
-    # with open('../../model/chat/data/opendialkg/test_data_processed.jsonl', encoding='utf-8') as f:
-    #     for line in f:
-    #         data = json.loads(line)
-    #         data_id = f"{data['dialog_id']}_{data['turn_id']}"
-    #         if data_id not in test_data_dialog_id_set:
-    #             print(data_id)
-    #         cnt += 1
-    # assert cnt == len(test_data_list)
+        json.dump([data_id(i) for i in test_index_list], f, ensure_ascii=False)
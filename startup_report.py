@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+# 启动开销报告：各模块的导入耗时，以及加载知识图谱和物品embedding之后的常驻内存
+#
+# python startup_report.py --kg-dataset opendialkg [--module CHATCRS] [--top 20] [--output report.json]
+#
+# 导入耗时在子进程中用 python -X importtime 测量，不受当前进程已导入模块的影响。
+
+_IMPORTTIME_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+\d+\s+\|\s*(\S+)")
+
+
+def measure_import_time(module: str = "CHATCRS") -> Dict:
+    """
+    在子进程中导入module
+
+    Returns:
+        dict: total_seconds 总导入耗时，packages 按顶层包汇总的自身耗时（秒），failed 导入失败时的错误信息
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    packages = defaultdict(float)
+    lines = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        self_us, name = match.groups()
+        packages[name.split(".")[0]] += int(self_us) / 1e6
+
+    return {
+        "module": module,
+        "total_seconds": sum(packages.values()),
+        "wall_seconds": wall,
+        "packages": dict(sorted(packages.items(), key=lambda x: -x[1])),
+        "failed": "\n".join(lines[-5:]) if proc.returncode != 0 else None,
+    }
+
+
+def get_rss_mb() -> float:
+    """当前进程的常驻内存（MB），读取 /proc/self/status，其他平台用 ru_maxrss 近似"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def measure_resources(kg_dataset: str) -> Dict:
+    """在当前进程中加载KG资源，记录耗时和加载前后的常驻内存"""
+    rss_before = get_rss_mb()
+    start = time.perf_counter()
+    from kg_resources import get_kg_resources
+    resources = get_kg_resources(kg_dataset)
+    return {
+        "kg_dataset": kg_dataset,
+        "load_seconds": time.perf_counter() - start,
+        "rss_before_mb": rss_before,
+        "rss_after_mb": get_rss_mb(),
+        "num_items": len(resources.id2item_id_arr),
+        "item_emb_shape": list(resources.item_emb_arr.shape),
+        "item_emb_dtype": str(resources.item_emb_arr.dtype),
+    }
+
+
+def print_report(imports: Dict, resources: Dict = None, top: int = 20):
+    print(f"导入 {imports['module']}: {imports['total_seconds']:.3f}s（子进程总耗时 {imports['wall_seconds']:.3f}s）")
+    if imports["failed"]:
+        print(f"  导入失败: {imports['failed']}")
+    rows: List = list(imports["packages"].items())[:top]
+    for name, seconds in rows:
+        print(f"  {name:<24} {seconds * 1000:9.1f} ms")
+    if resources is not None:
+        print(f"加载 {resources['kg_dataset']}: {resources['load_seconds']:.2f}s，"
+              f"{resources['num_items']} 个物品 {resources['item_emb_shape']} {resources['item_emb_dtype']}")
+        print(f"  常驻内存 {resources['rss_before_mb']:.0f} MB -> {resources['rss_after_mb']:.0f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="导入耗时与常驻内存报告")
+    parser.add_argument("--module", default="CHATCRS", help="测量导入耗时的模块")
+    parser.add_argument("--kg-dataset", default=None, help="提供时加载该数据集的KG与embedding并报告内存")
+    parser.add_argument("--top", type=int, default=20, help="显示耗时最多的前N个包")
+    parser.add_argument("--output", default=None, help="同时把报告写入JSON文件")
+    args = parser.parse_args()
+
+    imports = measure_import_time(args.module)
+    resources = measure_resources(args.kg_dataset) if args.kg_dataset else None
+    print_report(imports, resources, top=args.top)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"imports": imports, "resources": resources}, f, ensure_ascii=False, indent=2)
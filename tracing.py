@@ -0,0 +1,243 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# 模拟流程的分段耗时与指标
+#
+# - span(name, **attrs)：记录一段代码的耗时，写入JSONL追踪文件（每个span一行）
+# - record_usage / count：把API返回的token用量、缓存命中、重试、降级等计数记到当前span及其所有上层span
+#   （如对话级span汇总整个对话的token数）
+# - 当前span保存在contextvars中，同一线程内嵌套调用自动关联；跨线程提交任务时用 contextvars.copy_context()
+# - start_metrics_server(port)：以Prometheus文本格式在 /metrics 暴露累计指标
+# - Tracer.summary()：批次结束时各span的p50/p95/p99与总token数
+
+# cached_tokens：prompt中命中服务端前缀缓存的token数（usage.prompt_tokens_details.cached_tokens）
+TOKEN_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens")
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("percrs_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.status = "ok"
+
+    def add(self, key: str, n=1):
+        self.counts[key] += n
+
+    def to_record(self) -> Dict:
+        record = {
+            "name": self.name,
+            "parent": self.parent.name if self.parent is not None else None,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+        }
+        record.update(self.attrs)
+        record.update(self.counts)
+        return record
+
+
+class Tracer:
+    """
+    Args:
+        path: JSONL追踪文件，None表示只在内存中汇总
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._file = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.totals: Dict[str, int] = defaultdict(int)
+
+    def finish(self, span: Span):
+        with self._lock:
+            self.durations[span.name].append(span.duration)
+            if span.status != "ok":
+                self.errors[span.name] += 1
+            if self._file is not None:
+                self._file.write(json.dumps(span.to_record(), ensure_ascii=False) + "\n")
+
+    def add(self, key: str, n=1):
+        with self._lock:
+            self.totals[key] += n
+
+    def observe(self, name: str, seconds: float):
+        """记录不对应代码段的耗时（如流式调用的首token延迟），与span一起汇总分位数"""
+        with self._lock:
+            self.durations[name].append(seconds)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def summary(self) -> Dict:
+        """各span的次数、错误数和p50/p95/p99耗时（毫秒），以及计数总和"""
+        with self._lock:
+            durations = {name: np.asarray(values) * 1000 for name, values in self.durations.items()}
+            errors = dict(self.errors)
+            totals = dict(self.totals)
+        spans = {}
+        for name, values in durations.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            spans[name] = {"count": len(values), "errors": errors.get(name, 0),
+                           "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99),
+                           "total_s": float(values.sum() / 1000)}
+        return {"spans": spans, "totals": totals}
+
+    def print_summary(self):
+        summary = self.summary()
+        print("耗时统计（毫秒）:")
+        for name, s in sorted(summary["spans"].items(), key=lambda x: -x[1]["total_s"]):
+            print(f"  {name:<20} n={s['count']:<7} p50={s['p50_ms']:9.1f} p95={s['p95_ms']:9.1f} "
+                  f"p99={s['p99_ms']:9.1f} 错误={s['errors']}")
+        totals = summary["totals"]
+        tokens = ", ".join(f"{field}={totals.get(field, 0)}" for field in TOKEN_FIELDS)
+        others = ", ".join(f"{k}={v}" for k, v in sorted(totals.items()) if k not in TOKEN_FIELDS)
+        print(f"token总数: {tokens}")
+        if totals.get("prompt_tokens"):
+            print(f"前缀缓存命中率: {totals.get('cached_tokens', 0) / totals['prompt_tokens']:.1%}")
+        if others:
+            print(f"事件计数: {others}")
+
+    def prometheus_text(self) -> str:
+        """Prometheus文本格式的累计指标"""
+        summary = self.summary()
+        lines = ["# TYPE percrs_span_seconds summary"]
+        for name, s in summary["spans"].items():
+            for q, key in ((0.5, "p50_ms"), (0.95, "p95_ms"), (0.99, "p99_ms")):
+                lines.append(f'percrs_span_seconds{{span="{name}",quantile="{q}"}} {s[key] / 1000:.6f}')
+            lines.append(f'percrs_span_seconds_sum{{span="{name}"}} {s["total_s"]:.6f}')
+            lines.append(f'percrs_span_seconds_count{{span="{name}"}} {s["count"]}')
+        lines.append("# TYPE percrs_span_errors_total counter")
+        for name, s in summary["spans"].items():
+            lines.append(f'percrs_span_errors_total{{span="{name}"}} {s["errors"]}')
+        lines.append("# TYPE percrs_events_total counter")
+        for key, value in sorted(summary["totals"].items()):
+            lines.append(f'percrs_events_total{{event="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+_tracer: Optional[Tracer] = Tracer()
+_tracer_lock = threading.Lock()
+
+
+def configure_tracing(path: Optional[str] = None, enabled: bool = True) -> Optional[Tracer]:
+    """替换全局Tracer；enabled=False 时span不做任何记录"""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is not None:
+            _tracer.close()
+        _tracer = Tracer(path) if enabled else None
+        return _tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    记录一段代码的耗时
+
+    sample_id、turn 等属性会从上层span继承，异常时status为error并继续抛出
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield None
+        return
+    parent = _current_span.get()
+    if parent is not None:
+        attrs = {**{k: v for k, v in parent.attrs.items() if k in ("sample_id", "turn")}, **attrs}
+    current = Span(name, parent, attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.perf_counter() - current._start
+        tracer.finish(current)
+
+
+def count(key: str, n=1):
+    """给当前span及其上层span计数，并计入全局总数"""
+    tracer = _tracer
+    if tracer is None:
+        return
+    tracer.add(key, n)
+    current = _current_span.get()
+    while current is not None:
+        current.add(key, n)
+        current = current.parent
+
+
+def observe(name: str, seconds: float):
+    tracer = _tracer
+    if tracer is not None:
+        tracer.observe(name, seconds)
+
+
+def record_usage(usage: Optional[Dict]):
+    """记录API返回的usage中的token数，cached_tokens 取自 prompt_tokens_details"""
+    if not usage:
+        return
+    details = usage.get("prompt_tokens_details") or {}
+    for field in TOKEN_FIELDS:
+        value = usage.get(field) or details.get(field)
+        if value:
+            count(field, value)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        tracer = _tracer
+        if self.path.rstrip("/") != "/metrics" or tracer is None:
+            self.send_error(404)
+            return
+        body = tracer.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """在后台线程中启动 /metrics 服务"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server